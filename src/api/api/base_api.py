@@ -1,10 +1,75 @@
 from fastapi import APIRouter
-from typing import Callable, Optional, Any
+from typing import Callable, Optional, Any, AsyncIterator
 from fastapi import Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from msgspec import Struct
+from starlette.types import ASGIApp, Scope, Receive, Send
 
+from src.api.encoders import encode_lines, msgpack_decoder, MsgspecResponse, MsgpackResponse, MSGPACK_MEDIA_TYPES
+from src.database.database_client import DatabaseClient
+from src.common.lru_cache import LRUCache
 from src.common.logger import Logger
 
+
+# Number of rows returned by list endpoints when no limit is given, and the largest limit a client can ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Number of rows in each chunk NDJSON responses are written in
+STREAM_CHUNK_ROWS = 500
+
+# Methods of requests that write to the database
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware sending the reads of clients that have just written to the primary database, so e.g. a GET right
+    after a POST finds the created row while the replicas still lag behind. Clients are told apart by their
+    Authorization header, or by their address when they send none
+
+    :param db_client: (DatabaseClient) client of the database the reads are routed in
+    :param window: (float) number of seconds after a write the reads of the client go to the primary. It should exceed
+    the usual replication lag
+    :param max_clients: (int) number of clients with recent writes kept in memory
+    """
+
+    def __init__(self, app: ASGIApp, db_client: DatabaseClient, window: float = 5, max_clients: int = 100000):
+        self.app = app
+        self.db_client = db_client
+        self.recent_writes = LRUCache(maxsize=max_clients, ttl=window)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        client = self._client(scope)
+        if scope["method"] in WRITE_METHODS:
+            # Marked before and after the write, so the window starts once the write is committed
+            self.recent_writes.set(client, True)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                self.recent_writes.set(client, True)
+            return
+
+        if self.recent_writes.get(client) is None:
+            await self.app(scope, receive, send)
+            return
+
+        with self.db_client.read_your_writes():
+            await self.app(scope, receive, send)
+
+    @staticmethod
+    def _client(scope: Scope) -> str:
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                return value.decode("latin-1")
+        client = scope.get("client")
+        return client[0] if client else ""
+
+
 class BaseClassAPI:
     """
     This is an abstract class
@@ -50,4 +115,122 @@ class BaseClassAPI:
             prefix=self.prefix,
             tags=tags_par,
             responses={code_par: {"description": msg_par}},
-        )
\ No newline at end of file
+        )
+
+    @staticmethod
+    def pop_page_params(query_params: dict) -> tuple[int | None, int | None, bool]:
+        """
+        Removes pagination parameters from the query parameters of a list endpoint
+
+        :param query_params: (dict) query parameters of the request
+        :return: (tuple) limit, cursor (id of the last row of the previous page) and whether the rows should be
+        streamed as NDJSON. Limit is None for streamed responses without an explicit limit
+        """
+        limit = query_params.pop("limit", None)
+        cursor = query_params.pop("cursor", None)
+        stream = query_params.pop("format", "json") == "ndjson"
+
+        limit = int(limit) if limit is not None else (None if stream else DEFAULT_PAGE_SIZE)
+        cursor = int(cursor) if cursor is not None else None
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        return limit, cursor, stream
+
+    @staticmethod
+    def convert_int_params(query_params: dict, keys: list[str]) -> None:
+        """
+        Converts the query parameters filtering integer columns, as query parameters are strings and the statements
+        bind integers
+
+        :param query_params: (dict) query parameters of the request, changed in place
+        :param keys: (list) names of the integer parameters
+        :raises ValueError: when a value is not an integer
+        """
+        for key in keys:
+            if key in query_params:
+                query_params[key] = int(query_params[key])
+
+    @staticmethod
+    def accepts_msgpack(request: Request) -> bool:
+        # True when the Accept header of the request asks for MessagePack, unless it is excluded with q=0
+        for media_range in request.headers.get("accept", "").split(","):
+            media_type, *params = [part.strip() for part in media_range.split(";")]
+            if media_type.lower() in MSGPACK_MEDIA_TYPES:
+                quality = next((param.partition("=")[2] for param in params if param.lower().startswith("q=")), "1")
+                try:
+                    return float(quality) > 0
+                except ValueError:
+                    return True
+        return False
+
+    @staticmethod
+    async def read_payload(request: Request) -> Any:
+        # Body of the request, decoded as MessagePack or as JSON depending on its Content-Type. MessagePack timestamps
+        # are decoded to datetime
+        content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+        if content_type in MSGPACK_MEDIA_TYPES:
+            return msgpack_decoder.decode(await request.body())
+        return await request.json()
+
+    def respond(self, request: Request, status_code: int, content: Any, headers: dict = None) -> Response:
+        """
+        Encodes the content in the format the client asked for with the Accept header - MessagePack or JSON
+
+        :param request: (Request) request the response is for
+        :param status_code: (int) status code of the response
+        :param content: (Any) ResponseSchema, dict or anything else msgspec can encode
+        :param headers: (dict) additional headers of the response
+        :return: (Response) MsgpackResponse or MsgspecResponse
+        """
+        headers = {**(headers or {}), "Vary": "Accept"}
+        if self.accepts_msgpack(request):
+            return MsgpackResponse(status_code=status_code, content=content, headers=headers)
+        return MsgspecResponse(status_code=status_code, content=content, headers=headers)
+
+    def etag(self, request: Request, resource: str, version: int | None) -> str | None:
+        # Version of a table identifies every listing of it, so the ETag does not need the content of the response.
+        # Each encoding is a separate representation, with an ETag of its own. None when the table is not versioned
+        if version is None:
+            return None
+        return f'W/"{resource}-{version}{"-msgpack" if self.accepts_msgpack(request) else ""}"'
+
+    @staticmethod
+    def etag_headers(etag: str | None) -> dict | None:
+        # no-cache makes clients revalidate the listing on every request instead of reusing it blindly
+        return {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"} if etag is not None else None
+
+    @staticmethod
+    def etag_matches(request: Request, etag: str | None) -> bool:
+        """
+        Checks the If-None-Match header of a request against the current ETag of the resource
+
+        :param request: (Request) request to check
+        :param etag: (str) current ETag of the resource, None if it has none
+        :return: (bool) True if the client already has the current version, and 304 Not Modified can be returned
+        """
+        header = request.headers.get("if-none-match")
+        if header is None or etag is None:
+            return False
+
+        # Weak comparison - W/ prefixes are ignored
+        tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+    async def ndjson(self, rows: AsyncIterator[Any], to_schema: Callable[[Any], Struct]) -> AsyncIterator[bytes]:
+        # Rows are written out in chunks as they are read, so the whole result is never held in memory
+        chunk = []
+        try:
+            async for row in rows:
+                chunk.append(to_schema(row))
+                if len(chunk) >= STREAM_CHUNK_ROWS:
+                    yield encode_lines(chunk)
+                    chunk = []
+
+        except Exception as e:
+            # Response has already started, so its status can not change. The error is raised again, so the server
+            # aborts the connection without ending the response - clients see a truncated stream, not a complete one
+            self.logger.error("Error while streaming rows for %s: %s. %s", self.prefix, e.__class__.__name__, e)
+            raise
+
+        if chunk:
+            yield encode_lines(chunk)
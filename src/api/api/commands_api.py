@@ -1,7 +1,9 @@
 from fastapi import Path, Query, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse, Response
 
 from src.database.managers import CommandManager
+from src.database.errors import NotFoundError
+from src.api.encoders import ResponseSchema, command_schema
 from src.api.api.base_api import BaseClassAPI
 from src.common.logger import Logger
 
@@ -18,78 +20,116 @@ class CommandsAPI(BaseClassAPI):
         self.logger = Logger()
 
         @self.router.get("/")
-        async def get_commands(request: Request) -> JSONResponse:
+        async def get_commands(request: Request) -> Response:
             try:
                 query_params = dict(request.query_params)
-                self.logger.info(f"New GET {self.prefix}/?{"&".join([f"{key}={value}" for key, value in query_params.items()])} request received")
-                commands = await self.command_manager.get(**query_params)
-                self.logger.info(f"Successfully retrieved {len(commands)} commands from database using query {query_params}")
-                return JSONResponse(status_code=200,
-                                    content={"status": "success", "message": f"got {len(commands)} commands", "data": [
-                                        {
-                                            "id": command.id,
-                                            "date_time": command.date_time.timestamp(),
-                                            "device_id": command.device_id,
-                                            "command": command.command,
-                                            "kwargs": command.kwargs,
-                                            "status": command.status
-                                        } for command in commands
-                                    ]})
+                self.logger.info("New GET %s/?%s request received", self.prefix, request.query_params)
+                try:
+                    limit, cursor, stream = self.pop_page_params(query_params)
+                    self.convert_int_params(query_params, ["id", "device_id", "status"])
+                except ValueError as e:
+                    self.logger.warning("bad request while processing request for getting commands: %s", e)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": f"bad request, {str(e)}"})
+
+                if stream:
+                    commands = self.command_manager.stream(after_id=cursor, limit=limit, **query_params)
+                    return StreamingResponse(self.ndjson(commands, command_schema), media_type="application/x-ndjson")
+
+                commands = await self.command_manager.get(after_id=cursor, limit=limit, **query_params)
+                self.logger.info("Successfully retrieved %s commands from database using query %s", len(commands), query_params)
+                return self.respond(request, status_code=200, content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(commands)} commands",
+                    data=[command_schema(command, native=self.accepts_msgpack(request)) for command in commands],
+                    next_cursor=commands[-1].id if len(commands) == limit else None
+                ))
 
             except BaseException as e:
-                self.logger.error(f"Error while processing request for getting commands: {e.__class__.__name__}. {str(e)}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for getting commands: %s. %s", e.__class__.__name__, e)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.post("/")
-        async def create_device(request: Request) -> JSONResponse:
-            payload = await request.json()
-            self.logger.info(f"New POST {self.prefix}/ request received. Body: {payload}")
+        async def create_device(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New POST %s/ request received. Body: %s", self.prefix, payload)
             try:
                 command = await self.command_manager.create(**payload)
-                self.logger.info(f"Command {command.id} crated successfully. Body: {payload}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"Command {command.id} created successfully"})
+                self.logger.info("Command %s crated successfully. Body: %s", command.id, payload)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"Command {command.id} created successfully"})
+
+            except NotFoundError as e:
+                self.logger.warning("bad request while processing request for command creation: %s. Body: %s", e, payload)
+                return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, {str(e)}"})
+            except BaseException as e:
+                self.logger.error("Error while processing request for command creation: %s. %s. Body: %s", e.__class__.__name__, e, payload)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
+        @self.router.post("/bulk")
+        async def create_commands(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New POST %s/bulk request received. Body: %s", self.prefix, payload)
+            try:
+                command = payload.get("command")
+                filters = {key: payload.get(key) for key in ["user_id", "device_status", "device_ids"]}
+                if not command or all(value is None for value in filters.values()):
+                    self.logger.warning("bad request while processing request for bulk command creation: incorrect format. Body: %s", payload)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
+
+                count, first_id, last_id = await self.command_manager.create_many(
+                    command=command,
+                    kwargs=payload.get("kwargs"),
+                    status=payload.get("status", 0),
+                    **filters
+                )
+                self.logger.info("%s commands created successfully. Body: %s", count, payload)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"{count} commands created successfully", "data": {
+                    "count": count,
+                    "first_id": first_id,
+                    "last_id": last_id
+                }})
 
             except BaseException as e:
-                self.logger.error(f"Error while processing request for command creation: {e.__class__.__name__}. {str(e)}. Body: {payload}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for bulk command creation: %s. %s. Body: %s", e.__class__.__name__, e, payload)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.patch("/")
-        async def update_device(request: Request) -> JSONResponse:
-            payload = await request.json()
-            self.logger.info(f"New PATCH {self.prefix}/ request received. Body: {payload}")
+        async def update_device(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New PATCH %s/ request received. Body: %s", self.prefix, payload)
             try:
                 id = payload.get("id")
                 if not id:
-                    self.logger.warning(f"bad request while processing request for command update: incorrect format. Body: {payload}")
-                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
-
-                existing_commands = await self.command_manager.get(id=id)
-                if not existing_commands:
-                    self.logger.warning(f"bad request while processing request for command update: command with id '{id}' not found. Body: {payload}")
-                    return JSONResponse(status_code=404, content={"status": "error", "message": f"bad request, command with id '{id}' not found"})
+                    self.logger.warning("bad request while processing request for command update: incorrect format. Body: %s", payload)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
 
                 command = await self.command_manager.update(**payload)
-                self.logger.info(f"Command {command.id} updated successfully. Body: {payload}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"Command {command.id} updated successfully"})
+                if command is None:
+                    self.logger.warning("bad request while processing request for command update: command with id '%s' not found. Body: %s", id, payload)
+                    return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, command with id '{id}' not found"})
 
+                self.logger.info("Command %s updated successfully. Body: %s", command.id, payload)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"Command {command.id} updated successfully"})
+
+            except NotFoundError as e:
+                self.logger.warning("bad request while processing request for command update: %s. Body: %s", e, payload)
+                return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, {str(e)}"})
             except BaseException as e:
-                self.logger.error(f"Error while processing request for command update: {e.__class__.__name__}. {str(e)}. Body: {payload}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for command update: %s. %s. Body: %s", e.__class__.__name__, e, payload)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.delete("/{command_id}")
-        async def delete_device(command_id: int = Path(...)) -> JSONResponse:
-            self.logger.info(f"New DELETE {self.prefix}/{command_id} request received")
+        async def delete_device(request: Request, command_id: int = Path(...)) -> Response:
+            self.logger.info("New DELETE %s/%s request received", self.prefix, command_id)
             try:
-                commands = await self.command_manager.get(id=command_id)
-                if not commands:
-                    self.logger.warning(f"bad request while processing request for device deletion: Command {command_id} not found")
-                    return JSONResponse(status_code=404, content={"status": "success", "message": f"bad request, command {command_id} not found"})
+                if not await self.command_manager.delete(id=command_id):
+                    self.logger.warning("bad request while processing request for device deletion: Command %s not found", command_id)
+                    return self.respond(request, status_code=404, content={"status": "success", "message": f"bad request, command {command_id} not found"})
 
-                device = await self.command_manager.delete(id=command_id)
-                self.logger.info(f"Device {command_id} deleted successfully")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"Command {command_id} deleted successfully"})
+                self.logger.info("Device %s deleted successfully", command_id)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"Command {command_id} deleted successfully"})
 
             except BaseException as e:
                 self.logger.error(
-                    f"Error while processing request for device deletion: {e.__class__.__name__}. {str(e)}. command_id={command_id}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                    "Error while processing request for device deletion: %s. %s. command_id=%s", e.__class__.__name__, e, command_id)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
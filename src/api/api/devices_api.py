@@ -1,7 +1,9 @@
 from fastapi import Path, Query, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse, Response
 
 from src.database.managers import DeviceManager
+from src.database.errors import NotFoundError, ConflictError
+from src.api.encoders import ResponseSchema, device_schema, device_config_schema, device_status_schema
 from src.api.api.base_api import BaseClassAPI
 from src.common.logger import Logger
 
@@ -18,89 +20,164 @@ class DevicesAPI(BaseClassAPI):
         self.logger = Logger()
 
         @self.router.get("/")
-        async def get_devices(request: Request) -> JSONResponse:
+        async def get_devices(request: Request) -> Response:
             try:
                 query_params = dict(request.query_params)
-                self.logger.info(f"New GET {self.prefix}/?{"&".join([f"{key}={value}" for key, value in query_params.items()])} request received")
-                devices = await self.device_manager.get(**query_params)
-                self.logger.info(f"Successfully retrieved {len(devices)} devices devices from database using query {query_params}")
-                return JSONResponse(status_code=200,
-                                    content={"status": "success", "message": f"got {len(devices)} devices", "data": [
-                                        {
-                                            "id": device.id,
-                                            "name": device.name,
-                                            "user_id": device.user_id,
-                                            "last_seen": device.last_seen.timestamp(),
-                                            "status": device.status,
-                                            "regime": device.regime
-                                        } for device in devices
-                                    ]})
+                self.logger.info("New GET %s/?%s request received", self.prefix, request.query_params)
+                try:
+                    limit, cursor, stream = self.pop_page_params(query_params)
+                    self.convert_int_params(query_params, ["id", "user_id"])
+                except ValueError as e:
+                    self.logger.warning("bad request while processing request for getting devices: %s", e)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": f"bad request, {str(e)}"})
+
+                if stream:
+                    devices = self.device_manager.stream(after_id=cursor, limit=limit, **query_params)
+                    return StreamingResponse(self.ndjson(devices, device_schema), media_type="application/x-ndjson")
+
+                devices = await self.device_manager.get(after_id=cursor, limit=limit, **query_params)
+                self.logger.info("Successfully retrieved %s devices devices from database using query %s", len(devices), query_params)
+                return self.respond(request, status_code=200, content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(devices)} devices",
+                    data=[device_schema(device, native=self.accepts_msgpack(request)) for device in devices],
+                    next_cursor=devices[-1].id if len(devices) == limit else None
+                ))
 
             except BaseException as e:
-                self.logger.error(f"Error while processing request for getting devices: {e.__class__.__name__}. {str(e)}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for getting devices: %s. %s", e.__class__.__name__, e)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
+        @self.router.get("/config")
+        async def get_device_configs(request: Request) -> Response:
+            # Devices without the heartbeat columns. The listing only changes when users change devices, so it is
+            # versioned - clients that already have the current version get 304 without the rows being read
+            try:
+                query_params = dict(request.query_params)
+                self.logger.info("New GET %s/config?%s request received", self.prefix, request.query_params)
+                try:
+                    limit, cursor, _ = self.pop_page_params(query_params)
+                    self.convert_int_params(query_params, ["id", "user_id"])
+                    if "status" in query_params:
+                        raise ValueError("status is a heartbeat column and can not be filtered on, use /status")
+                except ValueError as e:
+                    self.logger.warning("bad request while processing request for getting device configs: %s", e)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": f"bad request, {str(e)}"})
+
+                if "if-none-match" in request.headers:
+                    etag = self.etag(request, "devices", await self.device_manager.version())
+                    if self.etag_matches(request, etag):
+                        self.logger.info("Device configs not modified since %s, query %s", etag, query_params)
+                        return Response(status_code=304, headers=self.etag_headers(etag))
+
+                version, devices = await self.device_manager.get_versioned(after_id=cursor, limit=limit, **query_params)
+                self.logger.info("Successfully retrieved %s device configs from database using query %s", len(devices), query_params)
+                return self.respond(request, status_code=200, headers=self.etag_headers(self.etag(request, "devices", version)), content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(devices)} devices",
+                    data=[device_config_schema(device) for device in devices],
+                    next_cursor=devices[-1].id if len(devices) == limit else None
+                ))
+
+            except BaseException as e:
+                self.logger.error("Error while processing request for getting device configs: %s. %s", e.__class__.__name__, e)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
+        @self.router.get("/status")
+        async def get_device_statuses(request: Request) -> Response:
+            # Heartbeat columns of the devices only. They change with every heartbeat, so the listing is not versioned
+            try:
+                query_params = dict(request.query_params)
+                self.logger.info("New GET %s/status?%s request received", self.prefix, request.query_params)
+                try:
+                    limit, cursor, _ = self.pop_page_params(query_params)
+                    self.convert_int_params(query_params, ["id", "user_id"])
+                except ValueError as e:
+                    self.logger.warning("bad request while processing request for getting device statuses: %s", e)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": f"bad request, {str(e)}"})
+
+                devices = await self.device_manager.get(after_id=cursor, limit=limit, **query_params)
+                self.logger.info("Successfully retrieved %s device statuses from database using query %s", len(devices), query_params)
+                return self.respond(request, status_code=200, content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(devices)} devices",
+                    data=[device_status_schema(device, native=self.accepts_msgpack(request)) for device in devices],
+                    next_cursor=devices[-1].id if len(devices) == limit else None
+                ))
+
+            except BaseException as e:
+                self.logger.error("Error while processing request for getting device statuses: %s. %s", e.__class__.__name__, e)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.post("/")
-        async def create_device(request: Request) -> JSONResponse:
-            payload = await request.json()
-            self.logger.info(f"New POST {self.prefix}/ request received. Body: {payload}")
+        async def create_device(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New POST %s/ request received. Body: %s", self.prefix, payload)
             try:
                 name = payload.get("name")
                 user_id = payload.get("user_id")
 
                 if None in {name, user_id}:
-                    self.logger.warning(f"bad request while processing request for device creation: incorrect format. Body: {payload}")
-                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
-
-                existing_devices = await self.device_manager.get(name=name, user_id=user_id)
-                if existing_devices:
-                    self.logger.warning(f"bad request while processing request for device creation: device with name '{name}' already exists. Body: {payload}")
-                    return JSONResponse(status_code=409, content={"status": "error", "message": f"bad request, device with name '{name}' already exists"})
+                    self.logger.warning("bad request while processing request for device creation: incorrect format. Body: %s", payload)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
 
                 device = await self.device_manager.create(**payload)
-                self.logger.info(f"Device {device.id} crated successfully. Body: {payload}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"Device {device.id} created successfully"})
-
+                self.logger.info("Device %s crated successfully. Body: %s", device.id, payload)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"Device {device.id} created successfully"})
+
+            except NotFoundError as e:
+                self.logger.warning("bad request while processing request for device creation: %s. Body: %s", e, payload)
+                return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, {str(e)}"})
+            except ConflictError as e:
+                self.logger.warning("bad request while processing request for device creation: %s. Body: %s", e, payload)
+                return self.respond(request, status_code=409, content={"status": "error", "message": f"bad request, {str(e)}"})
             except BaseException as e:
-                self.logger.error(f"Error while processing request for device creation: {e.__class__.__name__}. {str(e)}. Body: {payload}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for device creation: %s. %s. Body: %s", e.__class__.__name__, e, payload)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.patch("/")
-        async def update_device(request: Request) -> JSONResponse:
-            payload = await request.json()
-            self.logger.info(f"New PATCH {self.prefix}/ request received. Body: {payload}")
+        async def update_device(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New PATCH %s/ request received. Body: %s", self.prefix, payload)
             try:
                 id = payload.get("id")
                 if not id:
-                    self.logger.warning(f"bad request while processing request for device update: incorrect format. Body: {payload}")
-                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
-
-                existing_device = await self.device_manager.get(id=id)
-                if not existing_device:
-                    self.logger.warning(f"bad request while processing request for device update: device with id '{id}' not found. Body: {payload}")
-                    return JSONResponse(status_code=404, content={"status": "error", "message": f"bad request, device with id '{id}' not found"})
+                    self.logger.warning("bad request while processing request for device update: incorrect format. Body: %s", payload)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
 
                 device = await self.device_manager.update(**payload)
-                self.logger.info(f"Device {device.id} updated successfully. Body: {payload}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"Device {device.id} updated successfully"})
-
+                if device is None:
+                    self.logger.warning("bad request while processing request for device update: device with id '%s' not found. Body: %s", id, payload)
+                    return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, device with id '{id}' not found"})
+
+                self.logger.info("Device %s updated successfully. Body: %s", device.id, payload)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"Device {device.id} updated successfully"})
+
+            except NotFoundError as e:
+                self.logger.warning("bad request while processing request for device update: %s. Body: %s", e, payload)
+                return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, {str(e)}"})
+            except ConflictError as e:
+                self.logger.warning("bad request while processing request for device update: %s. Body: %s", e, payload)
+                return self.respond(request, status_code=409, content={"status": "error", "message": f"bad request, {str(e)}"})
             except BaseException as e:
-                self.logger.error(f"Error while processing request for device update: {e.__class__.__name__}. {str(e)}. Body: {payload}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for device update: %s. %s. Body: %s", e.__class__.__name__, e, payload)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.delete("/{device_id}")
-        async def delete_device(device_id: int = Path(...)) -> JSONResponse:
-            self.logger.info(f"New DELETE {self.prefix}/{device_id} request received")
+        async def delete_device(request: Request, device_id: int = Path(...)) -> Response:
+            self.logger.info("New DELETE %s/%s request received", self.prefix, device_id)
             try:
-                devices = await self.device_manager.get(id=device_id)
-                if not devices:
-                    self.logger.warning(f"bad request while processing request for device deletion: Device {device_id} not found")
-                    return JSONResponse(status_code=404, content={"status": "success", "message": f"Device {device_id} not found"})
+                if not await self.device_manager.delete(id=device_id):
+                    self.logger.warning("bad request while processing request for device deletion: Device %s not found", device_id)
+                    return self.respond(request, status_code=404, content={"status": "success", "message": f"Device {device_id} not found"})
 
-                device = await self.device_manager.delete(id=device_id)
-                self.logger.info(f"Device {device_id} deleted successfully")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"Device {device_id} deleted successfully"})
+                self.logger.info("Device %s deleted successfully", device_id)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"Device {device_id} deleted successfully"})
 
+            except ConflictError as e:
+                self.logger.warning("bad request while processing request for device deletion: %s", e)
+                return self.respond(request, status_code=409, content={"status": "error", "message": f"bad request, {str(e)}"})
             except BaseException as e:
-                self.logger.error(f"Error while processing request for device deletion: {e.__class__.__name__}. {str(e)}. device_id={device_id}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for device deletion: %s. %s. device_id=%s", e.__class__.__name__, e, device_id)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
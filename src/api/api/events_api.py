@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, UTC
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+from src.database.managers import EventManager
+from src.api.encoders import MsgspecResponse, ResponseSchema, event_schema, event_rollup_schema
+from src.api.api.base_api import BaseClassAPI
+from src.common.logger import Logger
+
+
+class EventsAPI(BaseClassAPI):
+    def __init__(
+            self,
+            prefix: str,
+            event_manager: EventManager
+    ):
+        super().__init__(prefix=prefix)
+
+        self.event_manager = event_manager
+        self.logger = Logger()
+
+        @self.router.get("/")
+        async def get_events(request: Request) -> Response:
+            try:
+                query_params = dict(request.query_params)
+                self.logger.info("New GET %s/?%s request received", self.prefix, request.query_params)
+                try:
+                    device_id, start, end = self.pop_range_params(query_params)
+                    limit, cursor, _ = self.pop_page_params(query_params)
+                except (ValueError, KeyError) as e:
+                    self.logger.warning("bad request while processing request for getting events: %s. %s", e.__class__.__name__, e)
+                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
+
+                events = await self.event_manager.get(device_id=device_id, start=start, end=end, after_id=cursor, limit=limit)
+                self.logger.info("Successfully retrieved %s events of device %s from database", len(events), device_id)
+                return MsgspecResponse(status_code=200, content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(events)} events",
+                    data=[event_schema(event) for event in events],
+                    next_cursor=events[-1].id if len(events) == limit else None
+                ))
+
+            except BaseException as e:
+                self.logger.error("Error while processing request for getting events: %s. %s", e.__class__.__name__, e)
+                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
+        @self.router.get("/rollups")
+        async def get_event_rollups(request: Request) -> Response:
+            try:
+                query_params = dict(request.query_params)
+                self.logger.info("New GET %s/rollups?%s request received", self.prefix, request.query_params)
+                try:
+                    device_id, start, end = self.pop_range_params(query_params)
+                    resolution = query_params.get("resolution", "hour")
+                    rollups = await self.event_manager.get_rollups(device_id=device_id, start=start, end=end, resolution=resolution)
+                except (ValueError, KeyError) as e:
+                    self.logger.warning("bad request while processing request for getting event rollups: %s. %s", e.__class__.__name__, e)
+                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
+
+                self.logger.info("Successfully retrieved %s %s event rollups of device %s from database", len(rollups), resolution, device_id)
+                return MsgspecResponse(status_code=200, content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(rollups)} event rollups",
+                    data=[event_rollup_schema(rollup) for rollup in rollups]
+                ))
+
+            except BaseException as e:
+                self.logger.error("Error while processing request for getting event rollups: %s. %s", e.__class__.__name__, e)
+                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
+    @staticmethod
+    def pop_range_params(query_params: dict) -> tuple[int, datetime, datetime]:
+        # device_id is required, start and end are unix timestamps and default to the last 24 hours
+        device_id = int(query_params.pop("device_id"))
+        end = query_params.pop("end", None)
+        end = datetime.fromtimestamp(float(end), UTC) if end is not None else datetime.now(UTC)
+        start = query_params.pop("start", None)
+        start = datetime.fromtimestamp(float(start), UTC) if start is not None else end - timedelta(days=1)
+        return device_id, start, end
@@ -0,0 +1,54 @@
+import time
+
+from fastapi.responses import PlainTextResponse
+from starlette.types import ASGIApp, Scope, Receive, Send, Message
+
+from src.api.api.base_api import BaseClassAPI
+from src.common.metrics import Metrics
+
+
+class RequestMetricsMiddleware:
+    """
+    ASGI middleware recording latency and status code of every REST request, labeled by route template
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.metrics = Metrics()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Route template instead of the raw path keeps the number of label values bounded
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            self.metrics.http_requests.inc(path, scope["method"], status)
+            self.metrics.http_latency.observe(path, scope["method"], value=time.perf_counter() - started)
+
+
+class MetricsAPI(BaseClassAPI):
+    def __init__(
+            self,
+            prefix: str
+    ):
+        super().__init__(prefix=prefix)
+
+        self.metrics = Metrics()
+
+        @self.router.get("")
+        async def get_metrics() -> PlainTextResponse:
+            return PlainTextResponse(self.metrics.render(), media_type="text/plain; version=0.0.4")
@@ -1,106 +1,187 @@
 from fastapi import Path, Query, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Scope, Receive, Send
 
 from src.database.managers import UserManager
+from src.database.errors import ConflictError
+from src.logic.credential_service import CredentialService
+from src.api.encoders import ResponseSchema, user_schema
 from src.api.api.base_api import BaseClassAPI
 from src.common.logger import Logger
 
 
+def _redacted(payload: dict) -> dict:
+    return {key: "***" if key == "password" else value for key, value in payload.items()}
+
+
+class AuthMiddleware:
+    """
+    ASGI middleware rejecting REST requests without a valid bearer token. The id of the authenticated user is put into
+    request.state.user_id. Verified tokens are cached by the credential service, so a request costs one cache lookup
+
+    :param credential_service: (CredentialService) service the tokens are verified with
+    :param exempt: (set[tuple[str, str]]) (method, path) pairs that do not require a token, e.g. login and sign up
+    """
+
+    def __init__(self, app: ASGIApp, credential_service: CredentialService, exempt: set[tuple[str, str]] = frozenset()):
+        self.app = app
+        self.credential_service = credential_service
+        self.exempt = exempt
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or (scope["method"], scope["path"]) in self.exempt:
+            await self.app(scope, receive, send)
+            return
+
+        user_id = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer":
+                    user_id = self.credential_service.verify_token(token.strip())
+                break
+
+        if user_id is None:
+            response = JSONResponse(status_code=401, content={"status": "error", "message": "unauthorized"}, headers={"WWW-Authenticate": "Bearer"})
+            await response(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})["user_id"] = user_id
+        await self.app(scope, receive, send)
+
+
 class UsersAPI(BaseClassAPI):
     def __init__(
             self,
             prefix: str,
-            user_manager: UserManager
-
+            user_manager: UserManager,
+            credential_service: CredentialService
     ):
         super().__init__(prefix=prefix)
 
         self.user_manager = user_manager
+        self.credential_service = credential_service
         self.logger = Logger()
 
         @self.router.get("/")
-        async def get_users(request: Request) -> JSONResponse:
+        async def get_users(request: Request) -> Response:
             try:
                 query_params = dict(request.query_params)
-                self.logger.info(f"New GET {self.prefix}/?{"&".join([f"{key}={value}" for key, value in query_params.items()])}")
-                users = await self.user_manager.get(**query_params)
-                self.logger.info(f"Successfully retrieved {len(users)} users from database using query {query_params}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"got {len(users)} users", "data": [
-                    {
-                        "id": user.id,
-                        "name": user.name,
-                        "email": user.email,
-                        "password": user.password,
-                        "created_at": user.created_at.timestamp()
-                    } for user in users
-                ]})
+                self.logger.info("New GET %s/?%s", self.prefix, request.query_params)
+                try:
+                    self.convert_int_params(query_params, ["id"])
+                except ValueError as e:
+                    self.logger.warning("bad request while processing request for getting users: %s", e)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": f"bad request, {str(e)}"})
+
+                # Clients that already have the current version of the table get 304 without the rows being read
+                if "if-none-match" in request.headers:
+                    etag = self.etag(request, "users", await self.user_manager.version())
+                    if self.etag_matches(request, etag):
+                        self.logger.info("Users not modified since %s, query %s", etag, query_params)
+                        return Response(status_code=304, headers=self.etag_headers(etag))
+
+                version, users = await self.user_manager.get_versioned(**query_params)
+                self.logger.info("Successfully retrieved %s users from database using query %s", len(users), query_params)
+                return self.respond(request, status_code=200, headers=self.etag_headers(self.etag(request, "users", version)), content=ResponseSchema(
+                    status="success",
+                    message=f"got {len(users)} users",
+                    data=[user_schema(user, native=self.accepts_msgpack(request)) for user in users]
+                ))
 
             except BaseException as e:
-                self.logger.error(f"Error while processing request for getting users: {e.__class__.__name__}. {str(e)}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for getting users: %s. %s", e.__class__.__name__, e)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.post("/")
-        async def create_user(request: Request) -> JSONResponse:
-            payload = await request.json()
-            self.logger.info(f"New POST {self.prefix}/ request received. Body: {payload}")
+        async def create_user(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New POST %s/ request received. Body: %s", self.prefix, _redacted(payload))
             try:
                 email = payload.get("email")
-                if not email:
-                    self.logger.warning(f"bad request while processing request for user creation: incorrect format. Body: {payload}")
-                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
-
-                existing_users = await self.user_manager.get(email=email)
-                if existing_users:
-                    self.logger.warning(f"bad request while processing request for user creation: user with email '{email}' already exists. Body: {payload}")
-                    return JSONResponse(status_code=409, content={"status": "error", "message": f"bad request, user with email '{email}' already exists"})
+                if not email or not payload.get("password"):
+                    self.logger.warning("bad request while processing request for user creation: incorrect format. Body: %s", _redacted(payload))
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
 
+                payload["password"] = await self.credential_service.hash_password(payload["password"])
                 user = await self.user_manager.create(**payload)
-                self.logger.info(f"User {user.id} crated successfully. Body: {payload}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"User {user.id} created successfully"})
+                self.logger.info("User %s crated successfully. Body: %s", user.id, _redacted(payload))
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"User {user.id} created successfully"})
 
+            except ConflictError as e:
+                self.logger.warning("bad request while processing request for user creation: %s. Body: %s", e, _redacted(payload))
+                return self.respond(request, status_code=409, content={"status": "error", "message": f"bad request, {str(e)}"})
             except BaseException as e:
-                self.logger.error(f"Error while processing request for user creation: {e.__class__.__name__}. {str(e)}. Body: {payload}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for user creation: %s. %s. Body: %s", e.__class__.__name__, e, _redacted(payload))
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.patch("/")
-        async def update_user(request: Request) -> JSONResponse:
-            payload = await request.json()
-            self.logger.info(f"New PATCH {self.prefix}/ request received. Body: {payload}")
+        async def update_user(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            self.logger.info("New PATCH %s/ request received. Body: %s", self.prefix, _redacted(payload))
             try:
                 id = payload.get("id")
                 if not id:
-                    self.logger.warning(f"bad request while processing request for user update: incorrect format. Body: {payload}")
-                    return JSONResponse(status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
-
-                existing_users = await self.user_manager.get(id=id)
-                if not existing_users:
-                    self.logger.warning(f"bad request while processing request for user update: user with id '{id}' not found. Body: {payload}")
-                    return JSONResponse(status_code=404, content={"status": "error", "message": f"bad request, user with id '{id}' not found"})
+                    self.logger.warning("bad request while processing request for user update: incorrect format. Body: %s", _redacted(payload))
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
 
+                if payload.get("password"):
+                    payload["password"] = await self.credential_service.hash_password(payload["password"])
                 user = await self.user_manager.update(**payload)
-                self.logger.info(f"User {user.id} updated successfully. Body: {payload}")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"User {user.id} updated successfully"})
+                if user is None:
+                    self.logger.warning("bad request while processing request for user update: user with id '%s' not found. Body: %s", id, _redacted(payload))
+                    return self.respond(request, status_code=404, content={"status": "error", "message": f"bad request, user with id '{id}' not found"})
+
+                self.logger.info("User %s updated successfully. Body: %s", user.id, _redacted(payload))
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"User {user.id} updated successfully"})
+
+            except ConflictError as e:
+                self.logger.warning("bad request while processing request for user update: %s. Body: %s", e, _redacted(payload))
+                return self.respond(request, status_code=409, content={"status": "error", "message": f"bad request, {str(e)}"})
+            except BaseException as e:
+                self.logger.error("Error while processing request for user update: %s. %s. Body: %s", e.__class__.__name__, e, _redacted(payload))
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
+
+        @self.router.post("/login")
+        async def login(request: Request) -> Response:
+            payload = await self.read_payload(request)
+            email, password = payload.get("email"), payload.get("password")
+            self.logger.info("New POST %s/login request received. Email: %s", self.prefix, email)
+            try:
+                if not email or not password:
+                    self.logger.warning("bad request while processing request for login: incorrect format. Email: %s", email)
+                    return self.respond(request, status_code=400, content={"status": "error", "message": "bad request, incorrect format"})
+
+                result = await self.credential_service.login(email=email, password=password)
+                if result is None:
+                    self.logger.warning("Failed login attempt. Email: %s", email, every=1)
+                    return self.respond(request, status_code=401, content={"status": "error", "message": "incorrect email or password"})
+
+                token, expires_at = result
+                self.logger.info("User with email %s logged in successfully", email)
+                return self.respond(request, status_code=200, content={"status": "success", "message": "logged in successfully", "data": {"token": token, "expires_at": expires_at}})
 
             except BaseException as e:
-                self.logger.error(f"Error while processing request for user update: {e.__class__.__name__}. {str(e)}. Body: {payload}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for login: %s. %s. Email: %s", e.__class__.__name__, e, email)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.delete("/{user_id}")
-        async def delete_user(user_id: int = Path(...)) -> JSONResponse:
-            self.logger.info(f"New DELETE {self.prefix}/{user_id} request received")
+        async def delete_user(request: Request, user_id: int = Path(...)) -> Response:
+            self.logger.info("New DELETE %s/%s request received", self.prefix, user_id)
             try:
-                users = await self.user_manager.get(id=user_id)
-                if not users:
-                    self.logger.warning(f"bad request while processing request for user deletion: User {user_id} not found")
-                    return JSONResponse(status_code=404, content={"status": "success", "message": f"User {user_id} not found"})
+                if not await self.user_manager.delete(id=user_id):
+                    self.logger.warning("bad request while processing request for user deletion: User %s not found", user_id)
+                    return self.respond(request, status_code=404, content={"status": "success", "message": f"User {user_id} not found"})
 
-                user = await self.user_manager.delete(id=user_id)
-                self.logger.info(f"User {user_id} deleted successfully")
-                return JSONResponse(status_code=200, content={"status": "success", "message": f"User {user_id} deleted successfully"})
+                self.logger.info("User %s deleted successfully", user_id)
+                return self.respond(request, status_code=200, content={"status": "success", "message": f"User {user_id} deleted successfully"})
 
+            except ConflictError as e:
+                self.logger.warning("bad request while processing request for user deletion: %s", e)
+                return self.respond(request, status_code=409, content={"status": "error", "message": f"bad request, {str(e)}"})
             except BaseException as e:
-                self.logger.error(f"Error while processing request for user deletion: {e.__class__.__name__}. {str(e)}. user_id={user_id}")
-                return JSONResponse(status_code=500, content={"status": "error", "message": "Internal Server Error"})
+                self.logger.error("Error while processing request for user deletion: %s. %s. user_id=%s", e.__class__.__name__, e, user_id)
+                return self.respond(request, status_code=500, content={"status": "error", "message": "Internal Server Error"})
 
         @self.router.get("/test")
         async def test():
@@ -0,0 +1,149 @@
+from datetime import datetime
+from typing import Any, Iterable
+
+import msgspec
+from fastapi.responses import Response
+
+from src.database.models import User, Device, Command, Event, EventRollupMinute, EventRollupHour
+
+
+class UserSchema(msgspec.Struct):
+    id: int
+    name: str | None
+    email: str | None
+    created_at: float | datetime | None
+
+
+class DeviceSchema(msgspec.Struct):
+    id: int
+    name: str | None
+    user_id: int | None
+    last_seen: float | datetime | None
+    status: str | None
+    regime: dict | None
+
+
+class DeviceConfigSchema(msgspec.Struct):
+    id: int
+    name: str | None
+    user_id: int | None
+    regime: dict | None
+
+
+class DeviceStatusSchema(msgspec.Struct):
+    id: int
+    last_seen: float | datetime | None
+    status: str | None
+
+
+class CommandSchema(msgspec.Struct):
+    id: int
+    date_time: float | datetime | None
+    device_id: int | None
+    command: str | None
+    kwargs: dict | None
+    status: int | None
+
+
+class EventSchema(msgspec.Struct):
+    id: int
+    date_time: float
+    device_id: int
+    payload: dict | None
+
+
+class EventRollupSchema(msgspec.Struct):
+    device_id: int
+    bucket: float
+    count: int
+    first_at: float | None
+    last_at: float | None
+
+
+class ResponseSchema(msgspec.Struct):
+    status: str
+    message: str
+    data: list | msgspec.UnsetType = msgspec.UNSET
+    next_cursor: int | None | msgspec.UnsetType = msgspec.UNSET
+
+
+def _timestamp(value: datetime | None, native: bool = False) -> float | datetime | None:
+    # Native timestamps are kept as datetime for encoders with a timestamp type, such as MessagePack
+    if native or value is None:
+        return value
+    return value.timestamp()
+
+
+def user_schema(user: User, native: bool = False) -> UserSchema:
+    return UserSchema(user.id, user.name, user.email, _timestamp(user.created_at, native))
+
+
+def device_schema(device: Device, native: bool = False) -> DeviceSchema:
+    return DeviceSchema(device.id, device.name, device.user_id, _timestamp(device.last_seen, native), device.status, device.regime)
+
+
+def device_config_schema(device: Device) -> DeviceConfigSchema:
+    return DeviceConfigSchema(device.id, device.name, device.user_id, device.regime)
+
+
+def device_status_schema(device: Device, native: bool = False) -> DeviceStatusSchema:
+    return DeviceStatusSchema(device.id, _timestamp(device.last_seen, native), device.status)
+
+
+def command_schema(command: Command, native: bool = False) -> CommandSchema:
+    return CommandSchema(command.id, _timestamp(command.date_time, native), command.device_id, command.command, command.kwargs, command.status)
+
+
+def event_schema(event: Event) -> EventSchema:
+    return EventSchema(event.id, event.date_time.timestamp(), event.device_id, event.payload)
+
+
+def event_rollup_schema(rollup: EventRollupMinute | EventRollupHour) -> EventRollupSchema:
+    return EventRollupSchema(rollup.device_id, rollup.bucket.timestamp(), rollup.count, _timestamp(rollup.first_at), _timestamp(rollup.last_at))
+
+
+json_encoder = msgspec.json.Encoder()
+msgpack_encoder = msgspec.msgpack.Encoder()
+msgpack_decoder = msgspec.msgpack.Decoder()
+
+MSGPACK_MEDIA_TYPES = {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+
+
+def encode_lines(items: Iterable[msgspec.Struct]) -> bytes:
+    # Newline-delimited JSON, one item per line
+    return json_encoder.encode_lines(items)
+
+
+def command_dict(command: Command) -> dict:
+    # Plain dict of a command, for transports that do their own serialization, such as ezRPC. Built directly from the
+    # row, without a schema in between, so the transport's encoding is the only pass over it
+    return {
+        "id": command.id,
+        "date_time": _timestamp(command.date_time),
+        "device_id": command.device_id,
+        "command": command.command,
+        "kwargs": command.kwargs,
+        "status": command.status
+    }
+
+
+class MsgspecResponse(Response):
+    """
+    JSON response encoded with msgspec. Content is usually a ResponseSchema, but anything msgspec can encode is accepted
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return json_encoder.encode(content)
+
+
+class MsgpackResponse(Response):
+    """
+    MessagePack response encoded with msgspec. Datetime values are written as MessagePack timestamps
+    """
+
+    media_type = "application/msgpack"
+
+    def render(self, content: Any) -> bytes:
+        return msgpack_encoder.encode(content)
@@ -1,10 +1,24 @@
-from sqlalchemy import update, delete, select
+import asyncio
 
 from src.database.managers import *
 from src.database.models import *
 from src.database.database_client import DatabaseClient
+from src.database.command_notifier import CommandNotifier
+from src.api.encoders import command_dict
 from src.common.logger import Logger
-from src.logic.time_checker import TimeChecker
+from src.common.metrics import track_rpc
+from src.logic.event_ingestor import EventIngestor
+from src.logic.heartbeat_tracker import HeartbeatTracker
+
+
+# Longest time a device can be parked in wait_commands, in seconds
+MAX_WAIT_TIMEOUT = 60
+
+# Largest number of command results accepted by one commands_completed call
+MAX_COMPLETED_BATCH = 1000
+
+# Hot paths of the devices log at most once per this number of seconds per call site, with the count of skipped records
+LOG_EVERY = 1
 
 
 class SystemRPC:
@@ -13,54 +27,84 @@ class SystemRPC:
             db_client: DatabaseClient,
             device_manager: DeviceManager,
             command_manager: CommandManager,
-            time_checker: TimeChecker
+            notifier: CommandNotifier,
+            event_ingestor: EventIngestor,
+            heartbeat_tracker: HeartbeatTracker
     ):
         self.db_client = db_client
         self.device_manager = device_manager
         self.command_manager = command_manager
-        self.time_checker = time_checker
+        self.notifier = notifier
+        self.event_ingestor = event_ingestor
+        self.heartbeat_tracker = heartbeat_tracker
 
         self.logger = Logger()
 
+    @track_rpc
     async def get_commands(self, device_id: int) -> list:
-        await self.time_checker.check(device_id)
-        commands = await self.command_manager.get(device_id=device_id, status=0)
-        commands_dict = [{
-            "id": command.id,
-            "date_time": command.date_time.timestamp(),
-            "device_id": command.device_id,
-            "command": command.command,
-            "kwargs": command.kwargs,
-            "status": command.status
-        } for command in commands]
-
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                update(Command)
-                .where(Command.id.in_({command.id for command in commands}))
-                .values(**{"status": 1})
-                .execution_options(synchronize_session="fetch")
-            )
-            await session.execute(stmt)
-            await session.commit()
-
-        self.logger.info(f"Successfully retrieved {len(commands)} commands for device {device_id}")
-        return commands_dict
+        self.heartbeat_tracker.touch(device_id)
+        commands = await self.command_manager.claim(device_id)
+        self.logger.info("Successfully retrieved %s commands for device %s", len(commands), device_id, every=LOG_EVERY)
+        return [command_dict(command) for command in commands]
+
+    @track_rpc
+    async def wait_commands(self, device_id: int, timeout: float = 30) -> list:
+        # Long-poll version of get_commands - returns as soon as there are commands for the device, or an empty list
+        # once the timeout passes
+        self.heartbeat_tracker.touch(device_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + min(max(timeout, 0), MAX_WAIT_TIMEOUT)
 
+        # Subscribe before claiming, so commands created between the claim and the wait are not missed
+        with self.notifier.subscribe(device_id) as new_commands:
+            while True:
+                new_commands.clear()
+                commands = await self.command_manager.claim(device_id)
+                remaining = deadline - loop.time()
+                if commands or remaining <= 0:
+                    break
+
+                try:
+                    await asyncio.wait_for(new_commands.wait(), remaining)
+                except TimeoutError:
+                    pass
+
+        self.logger.info("Successfully retrieved %s commands for device %s", len(commands), device_id, every=LOG_EVERY)
+        return [command_dict(command) for command in commands]
+
+    @track_rpc
     async def command_completed(self, command_id: int, status: int) -> None:
-        commands = await self.command_manager.get(id=command_id)
-        if not commands:
+        command = await self.command_manager.update(id=command_id, status=status)
+        if command is None:
             raise ValueError(f"No commands found with command_id={command_id}")
 
-        command = commands[0]
-        command.status = status
-        await self.command_manager.update(command)
-        self.logger.info(f"Command {command.id} - {command.command}({command.kwargs}) completed with status {status}")
+        self.heartbeat_tracker.touch(command.device_id)
+        self.logger.info("Command %s - %s(%s) completed with status %s", command.id, command.command, command.kwargs, status)
         return None
 
+    @track_rpc
+    async def commands_completed(self, device_id: int, results: list) -> list:
+        # Batch version of command_completed - results are [command_id, status] pairs of commands of the device.
+        # Returns the ids of the updated commands, results for unknown commands or commands of other devices are ignored
+        if len(results) > MAX_COMPLETED_BATCH:
+            raise ValueError(f"At most {MAX_COMPLETED_BATCH} command results can be reported at once")
+
+        self.heartbeat_tracker.touch(device_id)
+        reported = {int(command_id): int(status) for command_id, status in results}
+        completed = await self.command_manager.complete_many(device_id, list(reported.items()))
+        if len(completed) < len(reported):
+            self.logger.warning("Device %s reported results of %s unknown commands", device_id, len(reported) - len(completed))
+        self.logger.info("%s commands of device %s completed", len(completed), device_id, every=LOG_EVERY)
+        return completed
+
+    @track_rpc
     async def new_event(self, device_id: int, event: dict) -> None:
-        self.logger.info(f"New event received from device {device_id}. event: {event}")
+        self.logger.info("New event received from device %s. event: %s", device_id, event, every=LOG_EVERY)
+        self.heartbeat_tracker.touch(device_id)
+        if not await self.event_ingestor.submit(device_id, event):
+            self.logger.warning("Event of device %s dropped, event queue is full", device_id, every=LOG_EVERY)
 
+    @track_rpc
     async def test(self, message: str) -> str:
         return f"Message '{message}' received successfully!"
 
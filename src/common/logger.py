@@ -1,47 +1,157 @@
-
 # External imports
+import atexit
+import datetime
+import json
 import logging
+import os
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
 
 # Internal imports
 from src.common.singleton import singleton
 
 
+class _SnapshotQueueHandler(QueueHandler):
+    # The message is merged with its arguments in the calling thread, as the arguments may be changed by the caller
+    # after the call, e.g. request payloads. Formatting of the record - JSON, timestamps, exceptions - is left to the
+    # writer thread, unlike the default QueueHandler, which formats the whole record in the calling thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = f"{record.levelname}:{" " * (9 - len(record.levelname))}{record.getMessage()}"
+        fields = getattr(record, "fields", None)
+        if fields:
+            message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return message
+
+
+class _JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.UTC).isoformat(),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "pid": record.process,
+            **(getattr(record, "fields", None) or {})
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
 @singleton
 class Logger:
-    def __init__(self, level=logging.INFO):
+    """
+    Logger of the app. Records are passed through a queue to a background thread, which formats and writes them, so
+    logging never blocks the event loop. Messages take %-style arguments, e.g. logger.info("Device %s created",
+    device_id). They are only merged into the message for records that pass the level and the rate limits
+
+    Every method also takes:
+        disable - skip the record
+        every - log the call site at most once per given number of seconds. The number of skipped records is added to
+                the next one as the "suppressed" field
+        sample - log only the given share (0 to 1) of the calls of the call site
+        any other keyword argument - structured field of the record
+
+    :param level: (int) minimal level of the records
+    :param format: (str) "json" for one JSON object per record, "text" for plain lines
+    """
+
+    def __init__(self, level: int = None, format: str = None):
+        level = level or logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+        format = format or os.getenv("LOG_FORMAT", "json")
+
         # Create a logger object
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(level)
+        self.logger.propagate = False
+
+        # Create the handler writing to the console. It runs in the writer thread of the listener
+        self._console_handler = logging.StreamHandler()
+        self._console_handler.setFormatter(_JSONFormatter() if format == "json" else _TextFormatter())
 
         # Check if the logger already has handlers, to avoid adding duplicate handlers
-        if not self.logger.hasHandlers():
-            # Create a console handler to log to the console
-            console_handler = logging.StreamHandler()
-            console_handler.setLevel(level)
+        self._queue_handler = None
+        self._listener = None
+        if not self.logger.handlers:
+            self._queue_handler = _SnapshotQueueHandler(queue.SimpleQueue())
+            self.logger.addHandler(self._queue_handler)
+            self._start_listener()
+
+            atexit.register(self.close)
+
+            # Forking while the writer thread holds a lock, e.g. of the console stream, deadlocks the child. The thread
+            # is stopped before every fork, so processes are only forked without it, and started again on both sides
+            os.register_at_fork(before=self.close, after_in_parent=self._start_listener, after_in_child=self._start_listener)
+
+        # Call site -> (time the next record may be written at, number of records suppressed since the last one)
+        self._rate_limits: dict[tuple, list] = {}
+
+    def _start_listener(self) -> None:
+        self._queue_handler.queue = queue.SimpleQueue()
+        self._listener = QueueListener(self._queue_handler.queue, self._console_handler)
+        self._listener.start()
+
+    def close(self) -> None:
+        # Write out the records still in the queue and stop the writer thread. Called at exit - processes that end
+        # without running the exit handlers, like forked workers, have to call it themselves
+        if self._listener is not None and self._listener._thread is not None:
+            self._listener.stop()
+
+    def _log(
+            self,
+            level: int,
+            message,
+            args: tuple,
+            disable: bool,
+            every: float | None,
+            sample: float | None,
+            fields: dict
+    ) -> None:
+        if disable or not self.logger.isEnabledFor(level):
+            return
+        if sample is not None and random.random() >= sample:
+            return
 
-            # Create a logging format
-            formatter = logging.Formatter('%(levelname)s:%(message)s')
-            console_handler.setFormatter(formatter)
+        if every is not None:
+            # Key the limit by the code location that logged, two frames up - the caller of info(), error(), etc.
+            frame = sys._getframe(2)
+            site = (frame.f_code, frame.f_lineno)
+            now = time.monotonic()
+            limit = self._rate_limits.setdefault(site, [0.0, 0])
+            if now < limit[0]:
+                limit[1] += 1
+                return
+            if limit[1]:
+                fields["suppressed"] = limit[1]
+            limit[0] = now + every
+            limit[1] = 0
 
-            # Add the console handler to the logger
-            self.logger.addHandler(console_handler)
+        exc_info = fields.pop("exc_info", None)
+        self.logger.log(level, message, *args, exc_info=exc_info, extra={"fields": fields}, stacklevel=3)
 
-    def info(self, message, disable: bool = False):
-        if not disable:
-            self.logger.info(f"     {str(message)}")
+    def info(self, message, *args, disable: bool = False, every: float = None, sample: float = None, **fields):
+        self._log(logging.INFO, message, args, disable, every, sample, fields)
 
-    def error(self, message, disable: bool = False):
-        if not disable:
-            self.logger.error(f"    {str(message)}")
+    def error(self, message, *args, disable: bool = False, every: float = None, sample: float = None, **fields):
+        self._log(logging.ERROR, message, args, disable, every, sample, fields)
 
-    def debug(self, message, disable: bool = False):
-        if not disable:
-            self.logger.debug(f"    {str(message)}")
+    def debug(self, message, *args, disable: bool = False, every: float = None, sample: float = None, **fields):
+        self._log(logging.DEBUG, message, args, disable, every, sample, fields)
 
-    def warning(self, message, disable: bool = False):
-        if not disable:
-            self.logger.warning(f"  {str(message)}")
+    def warning(self, message, *args, disable: bool = False, every: float = None, sample: float = None, **fields):
+        self._log(logging.WARNING, message, args, disable, every, sample, fields)
 
-    def critical(self, message, disable: bool = False):
-        if not disable:
-            self.logger.critical(f" {str(message)}")
+    def critical(self, message, *args, disable: bool = False, every: float = None, sample: float = None, **fields):
+        self._log(logging.CRITICAL, message, args, disable, every, sample, fields)
@@ -0,0 +1,225 @@
+import asyncio
+import time
+from contextlib import suppress
+from functools import wraps
+from typing import Callable, Iterable
+
+from src.common.histogram import Histogram, LATENCY_BUCKETS
+from src.common.singleton import singleton
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[tuple, float] = {}
+
+    def set(self, *labels, value: float) -> None:
+        self.values[labels] = value
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in self.values.items()]
+
+
+class HistogramMetric(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        self.values: dict[tuple, Histogram] = {}
+
+    def observe(self, *labels, value: float) -> None:
+        histogram = self.values.get(labels)
+        if histogram is None:
+            histogram = self.values[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, histogram in self.values.items():
+            lines.extend(render_histogram(self.name, self.labelnames, labels, histogram))
+        return lines
+
+
+def render_histogram(name: str, labelnames: tuple[str, ...], labels: tuple, histogram: Histogram) -> list[str]:
+    # Prometheus buckets are cumulative
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(labelnames, labels, f'le="{bound}"')} {cumulative}")
+    lines.append(f"{name}_sum{_labels(labelnames, labels)} {histogram.total}")
+    lines.append(f"{name}_count{_labels(labelnames, labels)} {histogram.count}")
+    return lines
+
+
+@singleton
+class Metrics:
+    """
+    Registry of the metrics of the application, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.http_requests = Counter("http_requests_total", "REST requests by route, method and status code", ["route", "method", "status"])
+        self.http_latency = HistogramMetric("http_request_duration_seconds", "REST request latency by route and method", ["route", "method"])
+        self.rpc_calls = Counter("rpc_calls_total", "ezRPC calls by method and outcome", ["method", "outcome"])
+        self.rpc_latency = HistogramMetric("rpc_call_duration_seconds", "ezRPC call latency by method", ["method"])
+        self.loop_lag = Gauge("event_loop_lag_seconds", "Last measured delay of the asyncio event loop")
+        self.loop_lag_histogram = HistogramMetric("event_loop_lag_histogram_seconds", "Delays of the asyncio event loop")
+
+        self._metrics: list[_Metric] = [
+            self.http_requests, self.http_latency, self.rpc_calls, self.rpc_latency, self.loop_lag, self.loop_lag_histogram
+        ]
+        self._collectors: list[Callable[[], list[str]]] = []
+
+    def add_collector(self, collector: Callable[[], list[str]]) -> None:
+        # Collector is called on every render and returns already formatted lines, for values read from other components
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+def metric_lines(name: str, help: str, values: dict[tuple, float], labelnames: Iterable[str] = (), type: str = "gauge") -> list[str]:
+    # Formats gauge or counter values for collectors
+    metric = Counter(name, help, labelnames) if type == "counter" else Gauge(name, help, labelnames)
+    metric.values = values
+    return metric.render()
+
+
+def track_rpc(method: Callable) -> Callable:
+    # Records latency and outcome of an RPC method. Signature and annotations are kept for ezRPC
+    metrics = Metrics()
+
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await method(*args, **kwargs)
+            outcome = "success"
+            return result
+        finally:
+            metrics.rpc_calls.inc(method.__name__, outcome)
+            metrics.rpc_latency.observe(method.__name__, value=time.perf_counter() - started)
+
+    return wrapper
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a sleeping task, which shows how long callbacks block the loop
+
+    :param interval: (float) number of seconds between two measurements
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.metrics = Metrics()
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - expected, 0.0)
+            self.metrics.loop_lag.set(value=lag)
+            self.metrics.loop_lag_histogram.observe(value=lag)
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server answering every request with the metrics of the process. With several workers, requests to
+    the shared REST port reach a random worker, so each worker serves its metrics on a port of its own, scraped as a
+    separate target
+
+    :param host: (str) address the server listens on
+    :param port: (int) port the server listens on
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.metrics = Metrics()
+        self._server: asyncio.Server | None = None
+
+    async def start(self) -> None:
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # The request itself does not matter - read its head and answer with the metrics
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.metrics.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
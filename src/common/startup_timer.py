@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Iterator, TypeVar
+
+
+T = TypeVar("T")
+
+
+class StartupTimer:
+    """
+    Breakdown of the time spent in the phases of the startup
+
+    :param started_at: (float) time.perf_counter() value the startup began at, e.g. taken before the imports
+    """
+
+    def __init__(self, started_at: float = None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.phases: dict[str, float] = {}
+        self._last_lap = self.started_at
+
+    def lap(self, name: str) -> None:
+        # Record the time since the previous lap as a phase - for code that is not inside of a function, e.g. imports
+        now = time.perf_counter()
+        self.phases[name] = now - self._last_lap
+        self._last_lap = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+            self._last_lap = time.perf_counter()
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        # Time one of several steps awaited in parallel
+        with self.phase(name):
+            return await awaitable
+
+    def report(self) -> dict:
+        return {
+            "phases": {name: round(duration, 4) for name, duration in self.phases.items()},
+            "total": round(self._last_lap - self.started_at, 4)
+        }
+
+    def summary(self) -> str:
+        report = self.report()
+        phases = ", ".join(f"{name} {duration * 1000:.0f}ms" for name, duration in report["phases"].items())
+        return f"Started in {report['total'] * 1000:.0f}ms ({phases})"
@@ -0,0 +1,134 @@
+# External imports
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+from typing import Callable
+
+# Internal imports
+from src.common.logger import Logger
+
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    # Listening socket created before the workers are forked, so all of them accept connections from it
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    """
+    Runs the server in several forked worker processes and coordinates their shutdown
+
+    :param workers: (int) number of worker processes
+    :param target: (Callable) function run in every worker, called with the index of the worker and the shared sockets
+    :param sockets: (list) listening sockets shared by all workers
+    :param shutdown_timeout: (float) number of seconds workers get to stop gracefully before they are killed
+    :param restart_backoff: (float) number of seconds before a crashed worker is restarted. Doubled with every crash
+    in a row, up to max_restart_backoff
+    :param max_restart_backoff: (float) maximal number of seconds before a crashed worker is restarted
+    :param stable_after: (float) number of seconds a worker has to run for its crashes to stop counting as in a row
+    """
+
+    def __init__(
+            self,
+            workers: int,
+            target: Callable[[int, list[socket.socket]], None],
+            sockets: list[socket.socket],
+            shutdown_timeout: float = 30,
+            restart_backoff: float = 1,
+            max_restart_backoff: float = 60,
+            stable_after: float = 30
+    ):
+        self.workers = workers
+        self.target = target
+        self.sockets = sockets
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.stable_after = stable_after
+        self.logger = Logger()
+
+        self._context = multiprocessing.get_context("fork")
+        self._processes: dict[int, multiprocessing.Process] = {}
+        self._started_at: dict[int, float] = {}
+        self._crashes: dict[int, int] = {}
+        self._restart_at: dict[int, float] = {}
+        self._stopping = False
+
+    def run(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+
+        # Restart workers that exit unexpectedly, until a stop signal arrives. Workers that keep crashing are
+        # restarted with an exponential backoff
+        while not self._stopping:
+            alive = [process.sentinel for index, process in self._processes.items() if index not in self._restart_at]
+            timeout = min([1.0, *(restart_at - time.monotonic() for restart_at in self._restart_at.values())])
+            wait(alive, timeout=max(timeout, 0))
+
+            now = time.monotonic()
+            for index, process in list(self._processes.items()):
+                if self._stopping:
+                    break
+                if index in self._restart_at:
+                    if now >= self._restart_at[index]:
+                        del self._restart_at[index]
+                        self._spawn(index)
+                    continue
+                if not process.is_alive():
+                    delay = self._restart_delay(index, now)
+                    self.logger.warning("system: Worker %s (pid %s) exited with code %s, restarting it in %.1f seconds", index, process.pid, process.exitcode, delay)
+                    self._restart_at[index] = now + delay
+
+        self._shutdown()
+
+    def _restart_delay(self, index: int, now: float) -> float:
+        # No delay after a worker that ran for a while, doubled with every crash shortly after a start
+        if now - self._started_at[index] >= self.stable_after:
+            self._crashes[index] = 0
+            return 0.0
+
+        self._crashes[index] = self._crashes.get(index, 0) + 1
+        return min(self.restart_backoff * 2 ** (self._crashes[index] - 1), self.max_restart_backoff)
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(target=self._worker_main, args=(index,), name=f"worker-{index}", daemon=False)
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        self.logger.info("system: Worker %s started with pid %s", index, process.pid)
+
+    def _worker_main(self, index: int) -> None:
+        # Forked workers inherit the handlers of the supervisor - restore the defaults, the server installs its own
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            self.target(index, self.sockets)
+        finally:
+            self.logger.close()
+
+    def _on_signal(self, signum: int, frame) -> None:
+        self._stopping = True
+
+    def _shutdown(self) -> None:
+        self.logger.info("system: Stopping %s workers", len(self._processes))
+        for process in self._processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+        for process in self._processes.values():
+            process.join(self.shutdown_timeout)
+            if process.is_alive():
+                self.logger.warning("system: Worker %s (pid %s) did not stop in time, killing it", process.name, process.pid)
+                process.kill()
+                process.join()
@@ -0,0 +1,165 @@
+import asyncio
+from contextlib import contextmanager, suppress
+from typing import Iterable, Iterator
+
+import asyncpg
+
+from src.database.database_client import DatabaseClient
+from src.common.logger import Logger
+
+
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes and longer
+MAX_PAYLOAD_SIZE = 7900
+
+
+class CommandNotifier:
+    """
+    Wakes up devices that are waiting for new commands
+
+    :param db_client: (DatabaseClient) client of the database the commands are stored in
+    :param use_listen: (bool) deliver notifications through PostgreSQL LISTEN/NOTIFY, so they reach the waiters of every
+    server process. If False, only the waiters of the current process are woken up
+    :param channel: (str) name of the PostgreSQL channel used for the notifications
+    :param reconnect_backoff: (float) number of seconds before the first attempt to reconnect a lost LISTEN connection.
+    Doubled after every failed attempt, up to max_reconnect_backoff
+    :param max_reconnect_backoff: (float) maximal number of seconds between two attempts to reconnect
+    """
+
+    def __init__(
+            self,
+            db_client: DatabaseClient,
+            use_listen: bool = False,
+            channel: str = "new_commands",
+            reconnect_backoff: float = 1,
+            max_reconnect_backoff: float = 30
+    ):
+        self.db_client = db_client
+        self.use_listen = use_listen
+        self.channel = channel
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.logger = Logger()
+
+        self.reconnects = 0
+        self._waiters: dict[int, set[asyncio.Event]] = {}
+        self._connection: asyncpg.Connection | None = None
+        self._reconnect_task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        # False while a LISTEN connection is lost - notifications then only reach the waiters of the current process
+        return not self.use_listen or self._connection is not None
+
+    async def start(self) -> None:
+        if not self.use_listen or self._connection is not None:
+            return
+
+        await self._connect()
+
+    async def stop(self) -> None:
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._reconnect_task
+            self._reconnect_task = None
+
+        if self._connection is None:
+            return
+
+        connection, self._connection = self._connection, None
+        await connection.close()
+
+    async def _connect(self) -> None:
+        connection = await self.db_client.connect_raw()
+        try:
+            await connection.add_listener(self.channel, self._on_notification)
+            connection.add_termination_listener(self._on_termination)
+        except BaseException:
+            await connection.close()
+            raise
+        self._connection = connection
+
+    def _on_termination(self, connection: asyncpg.Connection) -> None:
+        # Also called when stop closes the connection, which is no longer the current one by then
+        if connection is not self._connection:
+            return
+
+        self.logger.error("LISTEN connection of the command notifications was lost, reconnecting")
+        self._connection = None
+        if self._reconnect_task is None:
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = self.reconnect_backoff
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    await self._connect()
+                except Exception as e:
+                    self.logger.warning("Could not reconnect the LISTEN connection, retrying in %s seconds: %s. %s", min(delay * 2, self.max_reconnect_backoff), e.__class__.__name__, e)
+                    delay = min(delay * 2, self.max_reconnect_backoff)
+                    continue
+
+                self.reconnects += 1
+                self.logger.info("LISTEN connection of the command notifications reconnected")
+
+                # Notifications sent while the connection was down are lost - wake every waiter, so it claims again
+                self._wake(list(self._waiters))
+                return
+        finally:
+            self._reconnect_task = None
+
+    @contextmanager
+    def subscribe(self, device_id: int) -> Iterator[asyncio.Event]:
+        # The event is set every time new commands are created for the device while the subscription is active
+        event = asyncio.Event()
+        self._waiters.setdefault(device_id, set()).add(event)
+        try:
+            yield event
+        finally:
+            waiters = self._waiters.get(device_id)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._waiters[device_id]
+
+    async def notify(self, device_ids: Iterable[int]) -> None:
+        device_ids = set(device_ids)
+        if not device_ids:
+            return
+
+        if self._connection is None:
+            if self.use_listen:
+                self.logger.warning("LISTEN connection is down, command notifications only reach the current process", every=10)
+            self._wake(device_ids)
+            return
+
+        # Split the ids into payloads PostgreSQL accepts and send all of them with one query
+        payloads, payload = [], []
+        size = 0
+        for device_id in device_ids:
+            item = str(device_id)
+            if size + len(item) + 1 > MAX_PAYLOAD_SIZE:
+                payloads.append(",".join(payload))
+                payload, size = [], 0
+            payload.append(item)
+            size += len(item) + 1
+        payloads.append(",".join(payload))
+
+        try:
+            async with self._lock:
+                await self._connection.execute("SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload", self.channel, payloads)
+        except Exception as e:
+            # Waiters of other processes will pick the commands up when their wait times out
+            self.logger.error("Error while sending command notifications: %s. %s", e.__class__.__name__, e)
+            self._wake(device_ids)
+
+    def _on_notification(self, connection: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        self._wake(int(device_id) for device_id in payload.split(",") if device_id)
+
+    def _wake(self, device_ids: Iterable[int]) -> None:
+        for device_id in device_ids:
+            for event in self._waiters.get(device_id, ()):
+                event.set()
@@ -1,24 +1,185 @@
 import asyncio
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+import itertools
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Iterator
+
+import asyncpg
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine, async_sessionmaker
 from src.database.models import *
+from src.database.instrumentation import QueryInstrumentation, InstrumentedAsyncPool
+from src.common.logger import Logger
+
+
+# Set while reads of the current task have to see its own writes, see DatabaseClient.read_your_writes
+_read_from_primary: ContextVar[bool] = ContextVar("read_from_primary", default=False)
+
+
+class _Replica:
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        self.AsyncSessionDB = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        self.failed_until = 0.0
 
 
 class DatabaseClient:
+    """
+    :param db_dsn: (str) DSN of the primary database
+    :param replica_dsns: (list) DSNs of read replicas of the primary database. Read-only queries are spread over them
+    :param echo: (bool) log every statement. Logging is synchronous, so it should stay off outside of debugging
+    :param pool_size: (int) number of connections kept open in the pool of each database
+    :param max_overflow: (int) number of connections that can be opened above pool_size under load
+    :param replica_retry_after: (float) number of seconds a replica that failed to connect is skipped for
+    :param prepared_statement_cache_size: (int) number of prepared statements asyncpg keeps per connection. It has to
+    hold every statement of the hot paths, or they get prepared again on every call
+    :param instrumentation: (QueryInstrumentation) collector of statement latencies and pool usage. A default one is
+    created if not given
+    """
+
     def __init__(
             self,
-            db_dsn: str
+            db_dsn: str,
+            replica_dsns: list[str] = None,
+            echo: bool = False,
+            pool_size: int = 10,
+            max_overflow: int = 20,
+            replica_retry_after: float = 30,
+            prepared_statement_cache_size: int = 500,
+            instrumentation: QueryInstrumentation = None
     ):
         self.db_dsn = db_dsn
+        self.prepared_statement_cache_size = prepared_statement_cache_size
+        self.pool_size = pool_size
+        self.replica_retry_after = replica_retry_after
+        self.instrumentation = instrumentation or QueryInstrumentation()
+        self.logger = Logger()
 
-        self._engine = create_async_engine(self.db_dsn, echo=True)
+        self._engine = self._create_engine(db_dsn, "primary", echo, pool_size, max_overflow)
         self.AsyncSessionDB = async_sessionmaker(
             bind=self._engine,
             class_=AsyncSession,
             expire_on_commit=False
         )
 
+        self._replicas = [
+            _Replica(f"replica{i}", self._create_engine(dsn, f"replica{i}", echo, pool_size, max_overflow))
+            for i, dsn in enumerate(replica_dsns or [])
+        ]
+        self._replica_rotation = itertools.cycle(range(len(self._replicas)))
+
+    def _create_engine(self, dsn: str, name: str, echo: bool, pool_size: int, max_overflow: int) -> AsyncEngine:
+        # Other drivers, e.g. aiosqlite in the tests, reject the asyncpg settings
+        connect_args = {}
+        if make_url(dsn).get_driver_name() == "asyncpg":
+            connect_args["prepared_statement_cache_size"] = self.prepared_statement_cache_size
+
+        engine = create_async_engine(
+            dsn,
+            echo=echo,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            poolclass=InstrumentedAsyncPool,
+            connect_args=connect_args
+        )
+        self.instrumentation.attach(engine, name=name, max_connections=pool_size + max_overflow)
+        return engine
+
     async def start(self) -> None:
+        # create_all skips tables that already exist, with their indexes - indexes added to the models of existing
+        # tables are created on their own. Indexes on columns the table does not have yet fail until the columns are
+        # added by hand (see the README), without stopping the startup
         async with self._engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
 
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    async with self._engine.begin() as conn:
+                        await conn.execute(CreateIndex(index, if_not_exists=True))
+                except SQLAlchemyError as e:
+                    self.logger.error("Index %s could not be created: %s. %s", index.name, e.__class__.__name__, e)
+
+    async def prewarm(self, statements: list[tuple] = (), write_statements: list[tuple] = (), connections: int = None) -> None:
+        # Open the connections of every pool in parallel and run the statements on each of them, so the first
+        # requests wait neither for connecting nor for compiling and preparing the statements. Write statements only
+        # run on the primary - replicas reject them
+        engines = [(self._engine, "primary", [*statements, *write_statements])]
+        engines += [(replica.engine, replica.name, list(statements)) for replica in self._replicas]
+        results = await asyncio.gather(*(
+            self._prewarm_engine(engine, engine_statements, connections or self.pool_size) for engine, _, engine_statements in engines
+        ), return_exceptions=True)
+
+        for (_, name, _), result in zip(engines, results):
+            if isinstance(result, Exception):
+                self.logger.warning("Database %s could not be pre-warmed: %s. %s", name, result.__class__.__name__, result)
+
+    @staticmethod
+    async def _prewarm_engine(engine: AsyncEngine, statements: list, connections: int) -> None:
+        # Step 1: Check out all connections at once, so the pool has to open each of them
+        opened = await asyncio.gather(*(engine.connect() for _ in range(connections)), return_exceptions=True)
+        conns = [conn for conn in opened if not isinstance(conn, Exception)]
+        try:
+            # Step 2: Run the statements on every connection. Nothing is committed
+            async def run(conn) -> None:
+                for stmt, params in statements:
+                    await conn.execute(stmt, params)
+                await conn.rollback()
+
+            await asyncio.gather(*(run(conn) for conn in conns))
+        finally:
+            await asyncio.gather(*(conn.close() for conn in conns))
+
+        errors = [conn for conn in opened if isinstance(conn, Exception)]
+        if errors:
+            raise errors[0]
+
+    async def stop(self) -> None:
+        # Close the connections of every pool, e.g. before the process is forked
+        await self._engine.dispose()
+        for replica in self._replicas:
+            await replica.engine.dispose()
+
+    @contextmanager
+    def read_your_writes(self) -> Iterator[None]:
+        # Reads made inside of the block go to the primary, so they see writes that replicas may not have yet
+        token = _read_from_primary.set(True)
+        try:
+            yield
+        finally:
+            _read_from_primary.reset(token)
+
+    @asynccontextmanager
+    async def read_session(self) -> AsyncIterator[AsyncSession]:
+        # Session for read-only queries. It is opened on the next healthy replica, falling back to the primary when
+        # there are no replicas, none of them can be reached, or read_your_writes is active
+        session = None
+        if self._replicas and not _read_from_primary.get():
+            now = time.monotonic()
+            for _ in range(len(self._replicas)):
+                replica = self._replicas[next(self._replica_rotation)]
+                if replica.failed_until > now:
+                    continue
+
+                candidate = replica.AsyncSessionDB()
+                try:
+                    # Connect right away, so an unreachable replica is detected before the query runs
+                    await candidate.connection()
+                    session = candidate
+                    break
+                except (OSError, SQLAlchemyError, asyncio.TimeoutError) as e:
+                    await candidate.close()
+                    replica.failed_until = now + self.replica_retry_after
+                    self.logger.warning("Database %s is unreachable, reading from other databases: %s. %s", replica.name, e.__class__.__name__, e)
+
+        async with session or self.AsyncSessionDB() as session:
+            yield session
 
+    async def connect_raw(self) -> asyncpg.Connection:
+        # Plain asyncpg connection outside of the pool, for long-lived session state such as LISTEN
+        url = make_url(self.db_dsn).set(drivername="postgresql")
+        return await asyncpg.connect(url.render_as_string(hide_password=False))
@@ -0,0 +1,20 @@
+from sqlalchemy.exc import IntegrityError
+
+
+# SQLSTATE codes of the PostgreSQL constraint violations the managers translate
+FOREIGN_KEY_VIOLATION = "23503"
+UNIQUE_VIOLATION = "23505"
+
+
+class NotFoundError(ValueError):
+    # A row the operation refers to does not exist, e.g. the user of a new device
+    pass
+
+
+class ConflictError(ValueError):
+    # The operation conflicts with stored rows, e.g. a duplicate email or a row that is still referenced
+    pass
+
+
+def sqlstate(error: IntegrityError) -> str | None:
+    return getattr(error.orig, "sqlstate", None)
@@ -0,0 +1,172 @@
+import random
+import re
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, UTC
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from src.common.histogram import Histogram
+
+
+# Lists of bind parameters, e.g. "IN ($1, $2, $3)", and repeated rows of multi-row VALUES
+_PARAMETER_LIST = re.compile(r"\$\d+(?:::[\w ]+)?(?:\s*,\s*\$\d+(?:::[\w ]+)?)+")
+_VALUES_ROWS = re.compile(r"(\([^()]*\))(?:\s*,\s*\([^()]*\))+")
+_WHITESPACE = re.compile(r"\s+")
+
+# Statements beyond this number of distinct shapes are counted under a shared "other" shape
+MAX_SHAPES = 1000
+
+# Set while a checkout of the current task is being timed. Each task has its own value, so checkouts waiting at the
+# same time are all timed
+_in_checkout: ContextVar[bool] = ContextVar("in_checkout", default=False)
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """
+    Connection pool that reports how long each checkout waited for a connection
+    """
+
+    instrumentation: "QueryInstrumentation | None" = None
+
+    def _do_get(self):
+        # _do_get calls itself while retrying, only the outermost call is timed
+        if _in_checkout.get() or self.instrumentation is None:
+            return super()._do_get()
+
+        token = _in_checkout.set(True)
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            _in_checkout.reset(token)
+            self.instrumentation.record_checkout(time.perf_counter() - started)
+
+    def recreate(self) -> "InstrumentedAsyncPool":
+        pool = super().recreate()
+        pool.instrumentation = self.instrumentation
+        return pool
+
+
+class QueryInstrumentation:
+    """
+    Collects statement latencies and connection pool usage of the engines it is attached to
+
+    :param slow_query_threshold: (float) number of seconds after which a statement counts as slow
+    :param slow_query_sample_rate: (float) fraction of slow statements recorded in the slow-query log
+    :param slow_query_log_size: (int) number of most recent slow statements kept in the slow-query log
+    """
+
+    def __init__(
+            self,
+            slow_query_threshold: float = 0.1,
+            slow_query_sample_rate: float = 1.0,
+            slow_query_log_size: int = 100
+    ):
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_query_sample_rate = slow_query_sample_rate
+
+        self.statements: dict[str, Histogram] = {}
+        self.checkout_wait = Histogram()
+        self.slow_queries: deque[dict] = deque(maxlen=slow_query_log_size)
+        self.errors = 0
+
+        self._engines: dict[str, tuple[AsyncEngine, int]] = {}
+        self._shapes: dict[str, str] = {}
+
+    def attach(self, engine: AsyncEngine, name: str, max_connections: int) -> None:
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", self._before_execute)
+        event.listen(sync_engine, "after_cursor_execute", self._after_execute)
+        event.listen(sync_engine, "handle_error", self._on_error)
+
+        if isinstance(sync_engine.pool, InstrumentedAsyncPool):
+            sync_engine.pool.instrumentation = self
+        self._engines[name] = (engine, max_connections)
+
+    def record_checkout(self, elapsed: float) -> None:
+        self.checkout_wait.observe(elapsed)
+
+    def shape(self, statement: str) -> str:
+        # Statement with the variable-length parts collapsed, so calls that differ only in the number of
+        # parameters are counted together
+        shape = self._shapes.get(statement)
+        if shape is None:
+            shape = _PARAMETER_LIST.sub("$?", statement)
+            shape = _VALUES_ROWS.sub(r"\1, ...", shape)
+            shape = _WHITESPACE.sub(" ", shape).strip()
+            if len(self._shapes) < MAX_SHAPES * 10:
+                self._shapes[statement] = shape
+        return shape
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        shape = self.shape(statement)
+
+        histogram = self.statements.get(shape)
+        if histogram is None:
+            if len(self.statements) >= MAX_SHAPES:
+                shape = "other"
+            histogram = self.statements.setdefault(shape, Histogram())
+        histogram.observe(elapsed)
+
+        if elapsed >= self.slow_query_threshold and random.random() < self.slow_query_sample_rate:
+            self.slow_queries.append({
+                "at": datetime.now(UTC).isoformat(),
+                "duration": elapsed,
+                "statement": shape,
+                "parameters": self._redact(parameters, executemany)
+            })
+
+    def _on_error(self, exception_context) -> None:
+        self.errors += 1
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+    @staticmethod
+    def _redact(parameters, executemany: bool) -> dict:
+        # Only the types of the parameters are kept, never their values
+        if executemany:
+            rows = list(parameters)
+            return {"rows": len(rows), "types": [type(value).__name__ for value in rows[0]] if rows else []}
+        if isinstance(parameters, dict):
+            return {"types": {key: type(value).__name__ for key, value in parameters.items()}}
+        return {"types": [type(value).__name__ for value in parameters or ()]}
+
+    def pools(self) -> list[dict]:
+        pools = []
+        for name, (engine, max_connections) in self._engines.items():
+            pool = engine.sync_engine.pool
+            checked_out = pool.checkedout()
+            pools.append({
+                "name": name,
+                "size": pool.size(),
+                "checked_out": checked_out,
+                "overflow": pool.overflow(),
+                "max_connections": max_connections,
+                "saturation": checked_out / max_connections if max_connections else 0.0
+            })
+        return pools
+
+    def snapshot(self, top: int = 50) -> dict:
+        statements = sorted(self.statements.items(), key=lambda item: item[1].total, reverse=True)[:top]
+        return {
+            "statements": [{"statement": shape, **histogram.to_dict()} for shape, histogram in statements],
+            "errors": self.errors,
+            "checkout_wait": self.checkout_wait.to_dict(),
+            "pools": self.pools(),
+            "slow_queries": list(self.slow_queries)
+        }
+
+    def reset(self) -> None:
+        self.statements.clear()
+        self.checkout_wait = Histogram()
+        self.slow_queries.clear()
+        self.errors = 0
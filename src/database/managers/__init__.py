@@ -1,3 +1,4 @@
 from src.database.managers.command_manager import CommandManager
 from src.database.managers.device_manager import DeviceManager
 from src.database.managers.user_manager import UserManager
+from src.database.managers.event_manager import EventManager
@@ -0,0 +1,102 @@
+from typing import Callable, Hashable
+
+from sqlalchemy import select, bindparam, Select
+from sqlalchemy.sql import Executable
+
+from src.database.database_client import DatabaseClient
+from src.database.table_versions import TableVersions
+
+
+# Number of statements kept per manager - more than the combinations of filters the managers support
+STATEMENT_CACHE_SIZE = 256
+
+
+class StatementCache:
+    """
+    Statements built once per key, e.g. per combination of filters, and executed with bound parameters after that
+
+    :param maxsize: (int) maximal number of statements kept. Statements over the limit are built on every call
+    """
+
+    def __init__(self, maxsize: int = STATEMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+
+        self.hits = 0
+        self.misses = 0
+        self._statements: dict[Hashable, Executable] = {}
+
+    def get(self, key: Hashable, build: Callable[[], Executable]) -> Executable:
+        stmt = self._statements.get(key)
+        if stmt is not None:
+            self.hits += 1
+            return stmt
+
+        self.misses += 1
+        stmt = build()
+        if len(self._statements) < self.maxsize:
+            self._statements[key] = stmt
+        return stmt
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._statements),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+class BaseManager:
+    """
+    Base of the managers. Lookups go through statements cached per combination of the filters present, so a query
+    is built and compiled once instead of on every call, and the same SQL text lets asyncpg reuse its prepared
+    statement on every connection
+
+    :param db_client: (DatabaseClient) client of the database the manager works with
+    :param table_versions: (TableVersions) version counters of the tables, if the table of the manager is versioned
+    """
+
+    def __init__(self, db_client: DatabaseClient, table_versions: TableVersions = None):
+        self.db_client = db_client
+        self.table_versions = table_versions
+        self.statements = StatementCache()
+
+    @staticmethod
+    def _where(stmt: Select, model, keys: tuple[str, ...]) -> Select:
+        # Every filter compares the column of the same name with a bound parameter of the same name. after_id and
+        # limit are the keyset pagination parameters
+        for key in keys:
+            if key == "after_id":
+                stmt = stmt.where(model.id > bindparam("after_id"))
+            elif key != "limit":
+                stmt = stmt.where(getattr(model, key) == bindparam(key))
+        return stmt
+
+    def _build_select(self, model, keys: tuple[str, ...]) -> Select:
+        # Rows are returned in order of id, starting after the last id of the previous page
+        stmt = self._where(select(model), model, keys).order_by(model.id)
+        if "limit" in keys:
+            stmt = stmt.limit(bindparam("limit"))
+        return stmt
+
+    def _select(self, model, **filters) -> tuple[Select, dict]:
+        # Returns the cached statement for the filters that are set, and the parameters to execute it with
+        params = {key: value for key, value in filters.items() if value is not None}
+        keys = tuple(params)
+        return self.statements.get((model.__name__, keys), lambda: self._build_select(model, keys)), params
+
+    async def _version(self, model) -> int | None:
+        # Current version of the table of the model, or None when it is not versioned
+        if self.table_versions is None:
+            return None
+        return await self.table_versions.get(model.__tablename__)
+
+    async def _get_versioned(self, model, stmt: Select, params: dict) -> tuple[int | None, list]:
+        # Version is read before the rows in the same session, so the rows are never older than the version. Rows
+        # newer than it only cost the client one more full response. Both are read from the primary, like the version
+        # alone - rows read from a replica could be older than the version clients revalidate against
+        async with self.db_client.AsyncSessionDB() as session:
+            version = await self.table_versions.get(model.__tablename__, session) if self.table_versions is not None else None
+            result = await session.execute(stmt, params)
+            return version, result.scalars().all()
@@ -1,15 +1,81 @@
-from src.database.models import Device, Command
+from src.database.models import Device, Command, CommandHistory
 from src.database.database_client import DatabaseClient
-from sqlalchemy import update, delete, select
-from datetime import datetime
+from src.database.command_notifier import CommandNotifier
+from src.database.partitions import RangePartitioner
+from src.database.errors import NotFoundError, sqlstate, FOREIGN_KEY_VIOLATION
+from src.database.managers.base_manager import BaseManager
+from sqlalchemy import update, delete, select, literal, true, func, or_, and_, union_all, values, column, bindparam, DateTime, Integer, JSON, Select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, UTC
+from typing import AsyncIterator
 
 
-class CommandManager:
+# Statuses of commands still in the queue - pending and delivered. Commands with any other status are completed and
+# get moved to the history
+QUEUE_STATUSES = (0, 1)
+
+
+class CommandManager(BaseManager):
     def __init__(
             self,
             db_client: DatabaseClient,
+            notifier: CommandNotifier = None
     ):
-        self.db_client = db_client
+        super().__init__(db_client=db_client)
+        self.notifier = notifier
+        self.history_partitioner = RangePartitioner(db_client=db_client, table=CommandHistory.__tablename__, interval="month")
+
+    async def start(self) -> None:
+        now = datetime.now(UTC)
+        await self.history_partitioner.ensure_default()
+        await self.history_partitioner.ensure([now, self.history_partitioner.bounds(now)[1]])
+
+    async def _notify(self, device_ids: list[int]) -> None:
+        if self.notifier is not None:
+            await self.notifier.notify(device_ids)
+
+    def _select_commands(
+            self,
+            id: int = None,
+            date_time: datetime = None,
+            device_id: int = None,
+            command: str = None,
+            kwargs: dict = None,
+            status: int = None,
+            after_id: int = None,
+            limit: int = None
+    ) -> tuple[Select, dict]:
+        params = {
+            key: value for key, value in [
+                ("id", id), ("date_time", date_time), ("device_id", device_id), ("command", command),
+                ("kwargs", kwargs), ("status", status), ("after_id", after_id), ("limit", limit)
+            ] if value is not None
+        }
+        keys = tuple(params)
+
+        # Commands with a queue status are never in the history, so only the queue is read for them
+        queue_only = status in QUEUE_STATUSES
+        return self.statements.get(("commands", keys, queue_only), lambda: self._build_commands_select(keys, queue_only)), params
+
+    def _build_commands_select(self, keys: tuple[str, ...], queue_only: bool) -> Select:
+        # Commands are looked up in both the queue and the history. Each part is filtered and limited on its own, so
+        # both can use their indexes, and the results are merged in order of id
+        parts = []
+        for model in [Command] if queue_only else [Command, CommandHistory]:
+            part = select(model.id, model.date_time, model.device_id, model.command, model.kwargs, model.status)
+            part = self._where(part, model, keys)
+            if "limit" in keys:
+                part = part.order_by(model.id).limit(bindparam("limit"))
+            parts.append(part)
+
+        commands = union_all(*parts).subquery("all_commands") if len(parts) > 1 else parts[0].subquery("all_commands")
+        command_ = aliased(Command, commands, adapt_on_names=True)
+        stmt = select(command_).order_by(command_.id)
+        if "limit" in keys:
+            stmt = stmt.limit(bindparam("limit"))
+        return stmt
 
     async def get(
             self,
@@ -19,26 +85,141 @@ class CommandManager:
             device_id: int = None,
             command: str = None,
             kwargs: dict = None,
-            status: int = None
+            status: int = None,
+            after_id: int = None,
+            limit: int = None
     ) -> list[Command]:
+        stmt, params = self._select_commands(id, date_time, device_id, command, kwargs, status, after_id, limit)
+        async with self.db_client.read_session() as session:
+            result = await session.execute(stmt, params)
+            return result.scalars().all()
+
+    async def stream(
+            self,
+            *,
+            id: int = None,
+            date_time: datetime = None,
+            device_id: int = None,
+            command: str = None,
+            kwargs: dict = None,
+            status: int = None,
+            after_id: int = None,
+            limit: int = None,
+            batch_size: int = 1000
+    ) -> AsyncIterator[Command]:
+        # Same as get, but rows are read through a server-side cursor in batches, so memory use does not depend on
+        # the number of matching rows
+        stmt, params = self._select_commands(id, date_time, device_id, command, kwargs, status, after_id, limit)
+        async with self.db_client.read_session() as session:
+            result = await session.stream_scalars(stmt.execution_options(yield_per=batch_size), params)
+            async for command_ in result:
+                yield command_
+
+    @staticmethod
+    def _build_claim():
+        # Pick the device's pending commands and mark them as delivered in a single statement. Rows already locked
+        # by a concurrent poll are skipped, so two polls never hand out the same command
+        pending = (
+            select(Command.id)
+            .where(Command.device_id == bindparam("device_id"), Command.status == 0)
+            .order_by(Command.id)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        return (
+            update(Command)
+            .where(Command.id.in_(pending))
+            .values(status=1)
+            .returning(Command)
+            .execution_options(synchronize_session=False)
+        )
+
+    def warm_statements(self) -> list:
+        # Read-only statements of the device poll path, run once per connection at startup. They match no rows
+        return [self._select_commands(device_id=-1, status=0, limit=0)]
+
+    def warm_write_statements(self) -> list:
+        # Writing statements of the device poll path, run once per connection of the primary at startup. They match
+        # no rows
+        return [(self.statements.get("claim", self._build_claim), {"device_id": -1})]
+
+    async def archive(self, created_before: datetime, limit: int = 5000, delivered_before: datetime = None) -> int:
+        # Move a batch of completed commands created before the given time from the queue to the history. Delivered
+        # commands created before delivered_before are moved as well - their device never acknowledged them, and they
+        # are kept in the history with the delivered status. Returns the number of moved commands
+        archived = and_(Command.status.not_in(QUEUE_STATUSES), Command.date_time < created_before)
+        if delivered_before is not None:
+            archived = or_(archived, and_(Command.status == 1, Command.date_time < delivered_before))
+
+        async with self.db_client.AsyncSessionDB() as session:
+            # Step 1: Lock the batch. Commands locked by a concurrent archiver are skipped
+            result = await session.execute(
+                select(Command.id, Command.date_time)
+                .where(archived)
+                .order_by(Command.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            )
+            rows = result.all()
+            if not rows:
+                return 0
+
+            # Step 2: Create the history partitions the commands belong to
+            await self.history_partitioner.ensure(date_time for _, date_time in rows)
+
+            # Step 3: Delete the commands from the queue and insert them into the history in a single statement
+            moved = (
+                delete(Command)
+                .where(Command.id.in_([id for id, _ in rows]))
+                .returning(Command.id, Command.date_time, Command.device_id, Command.command, Command.kwargs, Command.status)
+                .cte("moved")
+            )
+            await session.execute(
+                insert(CommandHistory).from_select(
+                    ["id", "date_time", "device_id", "command", "kwargs", "status", "archived_at"],
+                    select(moved.c.id, moved.c.date_time, moved.c.device_id, moved.c.command, moved.c.kwargs, moved.c.status, func.now())
+                )
+            )
+            await session.commit()
+
+        return len(rows)
+
+    async def claim(self, device_id: int) -> list[Command]:
         async with self.db_client.AsyncSessionDB() as session:
-            stmt = select(Command)
-
-            if id is not None:
-                stmt = stmt.where(Command.id == id)
-            if date_time is not None:
-                stmt = stmt.where(Command.date_time == date_time)
-            if device_id is not None:
-                stmt = stmt.where(Command.device_id == device_id)
-            if command is not None:
-                stmt = stmt.where(Command.command == command)
-            if kwargs is not None:
-                stmt = stmt.where(Command.kwargs == kwargs)
-            if status is not None:
-                stmt = stmt.where(Command.status == status)
+            result = await session.execute(self.statements.get("claim", self._build_claim), {"device_id": device_id})
+            commands = result.scalars().all()
+            await session.commit()
+
+        return sorted(commands, key=lambda command_: command_.id)
+
+    async def complete_many(self, device_id: int, results: list[tuple[int, int]]) -> list[int]:
+        # Set the statuses reported by a device for its commands, given as (command_id, status) pairs, with a single
+        # UPDATE ... FROM (VALUES ...). Commands of other devices are left untouched. Returns the ids of updated commands
+        if not results:
+            return []
+
+        # Sorted, so concurrent acknowledgements lock the rows in the same order
+        reported = (
+            values(column("id", Integer), column("status", Integer), name="reported")
+            .data(sorted(dict(results).items()))
+        )
+        stmt = (
+            update(Command)
+            .where(Command.id == reported.c.id, Command.device_id == device_id)
+            .values(status=reported.c.status)
+            .returning(Command.id, Command.status)
+            .execution_options(synchronize_session=False)
+        )
 
+        async with self.db_client.AsyncSessionDB() as session:
             result = await session.execute(stmt)
-            return result.scalars().all()
+            updated = result.all()
+            await session.commit()
+
+        # Commands were put back into the queue
+        if any(status == 0 for _, status in updated):
+            await self._notify([device_id])
+        return sorted(id for id, _ in updated)
 
     async def create(
             self,
@@ -49,33 +230,113 @@ class CommandManager:
             kwargs: dict = None,
             status: int = None,
     ) -> Command:
+        if __command:
+            date_time, device_id, command = __command.date_time, __command.device_id, __command.command
+            kwargs, status = __command.kwargs, __command.status
+        elif any(value is None for value in [device_id, command, kwargs, status]):
+            raise ValueError(f"Incorrect values for command creation")
+
+        # The device is checked by the foreign key, instead of being looked up first
+        values = {"device_id": device_id, "command": command, "kwargs": kwargs, "status": status}
+        if date_time is not None:
+            values["date_time"] = date_time
+        stmt = insert(Command).values(**values).returning(Command)
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                command_ = (await session.scalars(stmt)).one()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise NotFoundError(f"No device found with id: {device_id}") from e
+            raise
+
+        if command_.status == 0:
+            await self._notify([command_.device_id])
+        return command_
+
+    async def create_many(
+            self,
+            command: str,
+            kwargs: dict = None,
+            status: int = 0,
+            date_time: datetime = None,
+            *,
+            user_id: int = None,
+            device_status: str = None,
+            device_ids: list[int] = None
+    ) -> tuple[int, int | None, int | None]:
+        # Create the same command for every device matching the filters, with a single INSERT ... SELECT.
+        # Returns the number of created commands and the lowest and highest of their ids
+        if all(value is None for value in [user_id, device_status, device_ids]):
+            raise ValueError(f"At least one device filter must be provided")
+
+        devices = select(
+            literal(date_time or datetime.now(UTC), DateTime(timezone=True)),
+            Device.id,
+            literal(command),
+            literal(kwargs or {}, JSON),
+            literal(status)
+        )
+        if user_id is not None:
+            devices = devices.where(Device.user_id == user_id)
+        if device_status is not None:
+            devices = devices.where(Device.status == device_status)
+        if device_ids is not None:
+            devices = devices.where(Device.id.in_(device_ids))
+
+        inserted = (
+            insert(Command)
+            .from_select(["date_time", "device_id", "command", "kwargs", "status"], devices)
+            .returning(Command.id, Command.device_id)
+            .cte("inserted")
+        )
+        stmt = select(
+            func.count(),
+            func.min(inserted.c.id),
+            func.max(inserted.c.id),
+            func.array_agg(inserted.c.device_id)
+        )
+
         async with self.db_client.AsyncSessionDB() as session:
-            if not __command and any(value is None for value in [device_id, command, kwargs, status]):
-                raise ValueError(f"Incorrect values for command creation")
+            result = await session.execute(stmt)
+            count, first_id, last_id, created_for = result.one()
+            await session.commit()
 
-            # Step 1: Find the user by email
-            result = await session.execute(
-                select(Device).where(Device.id == device_id if not __command else Device.id == __command.device_id)
-            )
-            device = result.scalar_one_or_none()
-            if not device:
-                raise ValueError(f"No device found with id: {device_id}")
-
-            # Step 2: Create the device with user_id
-            if not __command:
-                command_ = Command(
-                    date_time=date_time,
-                    device_id=device.id,
-                    command=command,
-                    kwargs=kwargs,
-                    status=status,
+        if status == 0:
+            await self._notify(created_for or [])
+        return count, first_id, last_id
+
+    async def create_scheduled(self, date_time: datetime, command: str = "turn_on") -> list[int]:
+        # Create the command for every device whose regime has an entry for the given minute, in a single statement.
+        # Devices that already got the command for this minute are skipped by the unique index of the scheduled
+        # commands, so ticks repeated by other nodes or after a restart are harmless. Ticks only run for the current
+        # minute, and completed commands stay in the queue for far longer, so the index still holds them
+        key = date_time.strftime("%H:%M")
+        stmt = (
+            insert(Command)
+            .from_select(
+                ["date_time", "device_id", "command", "kwargs", "status", "scheduled"],
+                select(
+                    literal(date_time, DateTime(timezone=True)),
+                    Device.id,
+                    literal(command),
+                    literal({}, JSON),
+                    literal(0),
+                    true()
                 )
-            else:
-                command_ = __command
+                .where(Device.regime[key].as_string().is_not(None))
+            )
+            .on_conflict_do_nothing(index_elements=[Command.device_id, Command.command, Command.date_time], index_where=Command.scheduled)
+            .returning(Command.device_id)
+        )
 
-            session.add(command_)
+        async with self.db_client.AsyncSessionDB() as session:
+            result = await session.execute(stmt)
+            device_ids = result.scalars().all()
             await session.commit()
-        return command_
+
+        await self._notify(device_ids)
+        return device_ids
 
     async def update(
             self,
@@ -86,48 +347,57 @@ class CommandManager:
             command: str = None,
             kwargs: dict = None,
             status: int = None
-    ) -> Command:
+    ) -> Command | None:
+        # Updates commands in the queue - commands in the history are final. Returns the updated command, or None when
+        # there is no such command in the queue
         if not __command:
             if not id:
                 raise ValueError(f"ID of user must be provided")
             values = {"date_time": date_time, "device_id": device_id, "command": command, "kwargs": kwargs, "status": status}
         else:
+            id = __command.id
             values = {"date_time": __command.date_time, "device_id": __command.device_id, "command": __command.command, "kwargs": __command.kwargs, "status": __command.status}
 
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                update(Command)
-                .where(Command.id == id if __command is None else Command.id == __command.id)
-                .values(
-                    **{k: v for k, v in values.items() if v is not None}
-                )
-                .execution_options(synchronize_session="fetch")
-            )
-            await session.execute(stmt)
-            await session.commit()
+        values = {k: v for k, v in values.items() if v is not None}
+        if not values:
+            commands = await self.get(id=id)
+            return commands[0] if commands else None
 
-            if not __command:
-                result = await session.execute(
-                    select(Command).where(Command.id == id)
-                )
-                return result.scalar_one_or_none()
+        stmt = (
+            update(Command)
+            .where(Command.id == id)
+            .values(**values)
+            .returning(Command)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                command_ = (await session.scalars(stmt)).one_or_none()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise NotFoundError(f"No device found with id: {values.get("device_id")}") from e
+            raise
 
-            else:
-                return __command
+        # Command was put back into the queue
+        if command_ is not None and values.get("status") == 0:
+            await self._notify([command_.device_id])
+        return command_
 
-    async def delete(self, __command: Command = None, id: int = None) -> None:
+    async def delete(self, __command: Command = None, id: int = None) -> bool:
+        # Returns False when there is no command with the id
         if not __command:
             if not id:
                 raise ValueError(f"ID of device must be provided")
-            condition = Command.id == id
         else:
-            condition = Command.id == __command.id
+            id = __command.id
+
+        # The command is either still in the queue or already in the history - delete it from both in one statement
+        from_queue = delete(Command).where(Command.id == id).returning(Command.id).cte("from_queue")
+        from_history = delete(CommandHistory).where(CommandHistory.id == id).returning(CommandHistory.id).cte("from_history")
+        stmt = union_all(select(from_queue.c.id), select(from_history.c.id))
 
         async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                delete(Command)
-                .where(condition)
-            )
-            await session.execute(stmt)
+            deleted = (await session.execute(stmt)).scalars().all()
             await session.commit()
-
+        return len(deleted) > 0
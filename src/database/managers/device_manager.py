@@ -1,15 +1,39 @@
-from src.database.models import Device, User
+from src.database.models import Device
 from src.database.database_client import DatabaseClient
-from sqlalchemy import update, delete, select
+from src.database.managers.base_manager import BaseManager
+from src.database.table_versions import TableVersions
+from src.common.lru_cache import LRUCache
+from src.database.errors import NotFoundError, ConflictError, sqlstate, FOREIGN_KEY_VIOLATION, UNIQUE_VIOLATION
+from sqlalchemy import update, delete, select, values, column, Integer, DateTime
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, UTC
+from typing import AsyncIterator
 
 
-class DeviceManager:
+# Statuses derived from the heartbeats of the devices
+STATUS_ONLINE = "online"
+STATUS_OFFLINE = "offline"
+
+# Columns set by users, as opposed to the heartbeat columns last_seen and status. Only they change the version of
+# the table, so heartbeats do not invalidate the ETags of the configuration listing
+CONFIG_COLUMNS = ["name", "user_id", "regime"]
+
+# Rows per heartbeat update, keeping the statement below the bind parameter limit of asyncpg
+HEARTBEAT_CHUNK_SIZE = 10000
+
+
+class DeviceManager(BaseManager):
     def __init__(
             self,
             db_client: DatabaseClient,
+            cache_size: int = 10000,
+            cache_ttl: float = 60,
+            table_versions: TableVersions = None
     ):
-        self.db_client = db_client
+        super().__init__(db_client=db_client, table_versions=table_versions)
+        # cache_size 0 disables the cache
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
 
     async def get(
             self,
@@ -17,22 +41,79 @@ class DeviceManager:
             id: int = None,
             name: str = None,
             user_id: int = None,
-            status: str = None
+            status: str = None,
+            after_id: int = None,
+            limit: int = None
     ) -> list[Device]:
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = select(Device)
+        # Lookups by id alone are served from the cache
+        by_id = id is not None and all(value is None for value in [name, user_id, status, after_id, limit])
+        if by_id:
+            device = self.cache.get(id)
+            if device is not None:
+                return [device]
 
-            if id is not None:
-                stmt = stmt.where(Device.id == id)
-            if name is not None:
-                stmt = stmt.where(Device.name == name)
-            if user_id is not None:
-                stmt = stmt.where(Device.user_id == user_id)
-            if status is not None:
-                stmt = stmt.where(Device.status == status)
+        stmt, params = self._select(Device, id=id, name=name, user_id=user_id, status=status, after_id=after_id, limit=limit)
+        # Rows that go into the cache are read from the primary - a row from a lagging replica would be served for the
+        # whole TTL of the cache
+        open_session = self.db_client.AsyncSessionDB if by_id else self.db_client.read_session
+        async with open_session() as session:
+            result = await session.execute(stmt, params)
+            devices = result.scalars().all()
 
-            result = await session.execute(stmt)
-            return result.scalars().all()
+        if by_id and devices:
+            self.cache.set(id, devices[0])
+        return devices
+
+    async def version(self) -> int | None:
+        return await self._version(Device)
+
+    async def get_versioned(
+            self,
+            *,
+            id: int = None,
+            name: str = None,
+            user_id: int = None,
+            status: str = None,
+            after_id: int = None,
+            limit: int = None
+    ) -> tuple[int | None, list[Device]]:
+        # Same as get, together with the version of the table the rows were read at. Not served from the cache
+        stmt, params = self._select(Device, id=id, name=name, user_id=user_id, status=status, after_id=after_id, limit=limit)
+        return await self._get_versioned(Device, stmt, params)
+
+    async def stream(
+            self,
+            *,
+            id: int = None,
+            name: str = None,
+            user_id: int = None,
+            status: str = None,
+            after_id: int = None,
+            limit: int = None,
+            batch_size: int = 1000
+    ) -> AsyncIterator[Device]:
+        # Same as get, but rows are read through a server-side cursor in batches, so memory use does not depend on
+        # the number of matching rows
+        stmt, params = self._select(Device, id=id, name=name, user_id=user_id, status=status, after_id=after_id, limit=limit)
+        async with self.db_client.read_session() as session:
+            result = await session.stream_scalars(stmt.execution_options(yield_per=batch_size), params)
+            async for device in result:
+                yield device
+
+    def warm_statements(self) -> list:
+        # Statements of the device lookups, run once per connection at startup. They match no rows
+        return [self._select(Device, id=-1), self._select(Device, user_id=-1, limit=0)]
+
+    async def warm(self) -> None:
+        # Fill the cache with the devices, so the first polls after startup do not all go to the database. Read from
+        # the primary, as the rows stay in the cache for its whole TTL
+        if not self.cache.maxsize:
+            return
+
+        async with self.db_client.AsyncSessionDB() as session:
+            result = await session.execute(select(Device).order_by(Device.id).limit(self.cache.maxsize))
+            for device in result.scalars():
+                self.cache.set(device.id, device)
 
     async def create(
             self,
@@ -42,32 +123,31 @@ class DeviceManager:
             status: str = None,
             regime: dict = None
     ) -> Device:
-        async with self.db_client.AsyncSessionDB() as session:
-            if not __device and any(val is None for val in [name, user_id, status, regime]):
-                raise ValueError(f"Incorrect values for device creation")
-
-            # Step 1: Find the user by email
-            result = await session.execute(
-                select(User).where(User.id == user_id if __device is None else User.id == __device.user_id)
-            )
-            user = result.scalar_one_or_none()
-            if not user:
-                raise ValueError(f"No user found with id: {user_id}")
-
-            # Step 2: Create the device with user_id
-            if not __device:
-                device = Device(
-                    name=name,
-                    user_id=user.id,
-                    last_seen=datetime.now(UTC),
-                    status=status,
-                    regime=regime
-                )
-            else:
-                device = __device
+        if __device:
+            name, user_id, status, regime = __device.name, __device.user_id, __device.status, __device.regime
+        elif any(val is None for val in [name, user_id, status, regime]):
+            raise ValueError(f"Incorrect values for device creation")
 
-            session.add(device)
-            await session.commit()
+        # Uniqueness of the name per user is checked by the insert itself - nothing is returned when the name is taken.
+        # The user is checked by the foreign key
+        stmt = (
+            insert(Device)
+            .values(name=name, user_id=user_id, last_seen=datetime.now(UTC), status=status, regime=regime)
+            .on_conflict_do_nothing(index_elements=[Device.user_id, Device.name])
+            .returning(Device)
+        )
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                device = (await session.scalars(stmt)).one_or_none()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise NotFoundError(f"No user found with id: {user_id}") from e
+            raise
+
+        if device is None:
+            raise ConflictError(f"Device with name '{name}' already exists")
+        self.cache.set(device.id, device)
         return device
 
     async def update(
@@ -79,48 +159,105 @@ class DeviceManager:
             last_seen: datetime = None,
             status: str = None,
             regime: dict = None
-    ) -> Device:
+    ) -> Device | None:
+        # Returns the updated device, or None when there is no device with the id
         if not __device:
             if not id:
                 raise ValueError(f"ID of user must be provided")
             values = {"name": name, "user_id": user_id, "last_seen": last_seen, "status": status, "regime": regime}
         else:
+            id = __device.id
             values = {"name": __device.name, "user_id": __device.user_id, "last_seen": __device.last_seen, "status": __device.status, "regime": __device.regime}
 
+        values = {k: v for k, v in values.items() if v is not None}
+        if not values:
+            devices = await self.get(id=id)
+            return devices[0] if devices else None
+
+        stmt = (
+            update(Device)
+            .where(Device.id == id)
+            .values(**values)
+            .returning(Device)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                device = (await session.scalars(stmt)).one_or_none()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise NotFoundError(f"No user found with id: {values.get("user_id")}") from e
+            if sqlstate(e) == UNIQUE_VIOLATION:
+                raise ConflictError(f"Device with name '{values.get("name")}' already exists") from e
+            raise
+
+        if device is not None:
+            self.cache.set(device.id, device)
+        return device
+
+    async def touch_many(self, last_seen: dict[int, datetime]) -> None:
+        # Set last_seen of many devices and mark them online, with one UPDATE ... FROM (VALUES ...) per chunk
+        rows = sorted(last_seen.items())
+
         async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                update(Device)
-                .where(Device.id == id if __device is None else Device.id == __device.id)
-                .values(
-                    **{k: v for k, v in values.items() if v is not None}
+            for i in range(0, len(rows), HEARTBEAT_CHUNK_SIZE):
+                heartbeats = (
+                    values(column("id", Integer), column("last_seen", DateTime(timezone=True)), name="heartbeats")
+                    .data(rows[i:i + HEARTBEAT_CHUNK_SIZE])
                 )
-                .execution_options(synchronize_session="fetch")
-            )
-            await session.execute(stmt)
+                stmt = (
+                    update(Device)
+                    .where(Device.id == heartbeats.c.id)
+                    .values(last_seen=heartbeats.c.last_seen, status=STATUS_ONLINE)
+                    .execution_options(synchronize_session=False)
+                )
+                await session.execute(stmt)
             await session.commit()
 
-            if not __device:
-                result = await session.execute(
-                    select(Device).where(Device.id == id)
-                )
-                return result.scalar_one_or_none()
+        for device_id, seen_at in rows:
+            device = self.cache.peek(device_id)
+            if device is not None:
+                device.last_seen = seen_at
+                device.status = STATUS_ONLINE
 
-            else:
-                return __device
+    async def mark_offline(self, seen_before: datetime) -> list[int]:
+        # Mark online devices that have not been seen since the given time as offline
+        stmt = (
+            update(Device)
+            .where(Device.status == STATUS_ONLINE, Device.last_seen < seen_before)
+            .values(status=STATUS_OFFLINE)
+            .returning(Device.id)
+            .execution_options(synchronize_session=False)
+        )
+        async with self.db_client.AsyncSessionDB() as session:
+            result = await session.execute(stmt)
+            device_ids = result.scalars().all()
+            await session.commit()
+
+        for device_id in device_ids:
+            device = self.cache.peek(device_id)
+            if device is not None:
+                device.status = STATUS_OFFLINE
+        return device_ids
 
-    async def delete(self, __device: Device = None, id: int = None) -> None:
+    async def delete(self, __device: Device = None, id: int = None) -> bool:
+        # Returns False when there is no device with the id
         if not __device:
             if not id:
                 raise ValueError(f"ID of device must be provided")
-            condition = Device.id == id
         else:
-            condition = Device.id == __device.id
+            id = __device.id
 
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                delete(Device)
-                .where(condition)
-            )
-            await session.execute(stmt)
-            await session.commit()
+        stmt = delete(Device).where(Device.id == id).returning(Device.id)
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                deleted = (await session.scalars(stmt)).one_or_none()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise ConflictError(f"Device {id} still has commands") from e
+            raise
 
+        self.cache.pop(id)
+        return deleted is not None
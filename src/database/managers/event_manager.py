@@ -0,0 +1,130 @@
+import json
+from datetime import datetime, timedelta, UTC
+
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
+
+from src.database.models import Event, EventRollupMinute, EventRollupHour
+from src.database.database_client import DatabaseClient
+from src.database.partitions import RangePartitioner
+
+
+ROLLUPS = {"minute": EventRollupMinute, "hour": EventRollupHour}
+
+# Rows per rollup upsert, keeping the statement below the bind parameter limit of asyncpg
+ROLLUP_CHUNK_SIZE = 5000
+
+
+class EventManager:
+    def __init__(
+            self,
+            db_client: DatabaseClient,
+    ):
+        self.db_client = db_client
+        self.partitioner = RangePartitioner(db_client=db_client, table=Event.__tablename__, interval="day")
+
+    async def start(self) -> None:
+        now = datetime.now(UTC)
+        await self.partitioner.ensure_default()
+        await self.partitioner.ensure([now, now + timedelta(days=1)])
+
+    async def create_many(self, events: list[tuple[datetime, int, dict]]) -> None:
+        # Events are (date_time, device_id, payload) tuples. Raw events are written with a single COPY, and the
+        # rollups are updated in the same transaction
+        await self.partitioner.ensure(date_time for date_time, _, _ in events)
+        records = [(date_time, device_id, json.dumps(payload)) for date_time, device_id, payload in events]
+
+        async with self.db_client.AsyncSessionDB() as session:
+            for resolution, model in ROLLUPS.items():
+                for stmt in self._rollup_upserts(model, resolution, events):
+                    await session.execute(stmt)
+
+            connection = await session.connection()
+            raw_connection = await connection.get_raw_connection()
+            await raw_connection.driver_connection.copy_records_to_table(
+                Event.__tablename__,
+                records=records,
+                columns=["date_time", "device_id", "payload"]
+            )
+            await session.commit()
+
+    @staticmethod
+    def _rollup_upserts(model: type[EventRollupMinute | EventRollupHour], resolution: str, events: list[tuple[datetime, int, dict]]) -> list:
+        # Aggregate the batch in memory, then merge it into the stored buckets
+        buckets: dict[tuple[int, datetime], list] = {}
+        for date_time, device_id, _ in events:
+            bucket = date_time.replace(second=0, microsecond=0)
+            if resolution == "hour":
+                bucket = bucket.replace(minute=0)
+
+            row = buckets.get((device_id, bucket))
+            if row is None:
+                buckets[(device_id, bucket)] = [1, date_time, date_time]
+            else:
+                row[0] += 1
+                row[1] = min(row[1], date_time)
+                row[2] = max(row[2], date_time)
+
+        # Sorted, so concurrent flushes lock the rows in the same order
+        rows = [
+            {"device_id": device_id, "bucket": bucket, "count": count, "first_at": first_at, "last_at": last_at}
+            for (device_id, bucket), (count, first_at, last_at) in sorted(buckets.items())
+        ]
+
+        statements = []
+        for i in range(0, len(rows), ROLLUP_CHUNK_SIZE):
+            stmt = insert(model).values(rows[i:i + ROLLUP_CHUNK_SIZE])
+            statements.append(stmt.on_conflict_do_update(
+                index_elements=[model.device_id, model.bucket],
+                set_={
+                    "count": model.count + stmt.excluded.count,
+                    "first_at": func.least(model.first_at, stmt.excluded.first_at),
+                    "last_at": func.greatest(model.last_at, stmt.excluded.last_at)
+                }
+            ))
+        return statements
+
+    async def get(
+            self,
+            *,
+            device_id: int,
+            start: datetime,
+            end: datetime,
+            after_id: int = None,
+            limit: int = None
+    ) -> list[Event]:
+        # Time range lets PostgreSQL skip every partition outside of it
+        stmt = (
+            select(Event)
+            .where(Event.device_id == device_id, Event.date_time >= start, Event.date_time < end)
+            .order_by(Event.id)
+        )
+        if after_id is not None:
+            stmt = stmt.where(Event.id > after_id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+
+        async with self.db_client.read_session() as session:
+            result = await session.execute(stmt)
+            return result.scalars().all()
+
+    async def get_rollups(
+            self,
+            *,
+            device_id: int,
+            start: datetime,
+            end: datetime,
+            resolution: str = "hour"
+    ) -> list[EventRollupMinute | EventRollupHour]:
+        model = ROLLUPS.get(resolution)
+        if model is None:
+            raise ValueError(f"Unsupported resolution: {resolution}")
+
+        stmt = (
+            select(model)
+            .where(model.device_id == device_id, model.bucket >= start, model.bucket < end)
+            .order_by(model.bucket)
+        )
+        async with self.db_client.read_session() as session:
+            result = await session.execute(stmt)
+            return result.scalars().all()
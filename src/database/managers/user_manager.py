@@ -1,97 +1,119 @@
 from src.database.models.user import User
 from src.database.database_client import DatabaseClient
-from sqlalchemy import update, delete, select
+from src.database.managers.base_manager import BaseManager
+from src.database.table_versions import TableVersions
+from src.database.errors import ConflictError, sqlstate, FOREIGN_KEY_VIOLATION, UNIQUE_VIOLATION
+from sqlalchemy import update, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 
 
-class UserManager:
+class UserManager(BaseManager):
     def __init__(
             self,
             db_client: DatabaseClient,
+            table_versions: TableVersions = None
     ):
-        self.db_client = db_client
+        super().__init__(db_client=db_client, table_versions=table_versions)
 
     async def get(
             self,
             *,
             id: int = None,
             name: str = None,
-            email: int = None,
-            password: str = None,
+            email: str = None,
             created_at: datetime = None
     ) -> list[User]:
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = select(User)
+        # Passwords are stored hashed with a random salt, so they can not be filtered on - see CredentialService
+        stmt, params = self._select(User, id=id, name=name, email=email, created_at=created_at)
+        async with self.db_client.read_session() as session:
+            result = await session.execute(stmt, params)
+            return result.scalars().all()
 
-            if id is not None:
-                stmt = stmt.where(User.id == id)
-            if name is not None:
-                stmt = stmt.where(User.name == name)
-            if email is not None:
-                stmt = stmt.where(User.email == email)
-            if password is not None:
-                stmt = stmt.where(User.password == password)
-            if created_at is not None:
-                stmt = stmt.where(User.created_at == created_at)
+    async def version(self) -> int | None:
+        return await self._version(User)
 
-            result = await session.execute(stmt)
-            return result.scalars().all()
+    async def get_versioned(
+            self,
+            *,
+            id: int = None,
+            name: str = None,
+            email: str = None,
+            created_at: datetime = None
+    ) -> tuple[int | None, list[User]]:
+        # Same as get, together with the version of the table the rows were read at
+        stmt, params = self._select(User, id=id, name=name, email=email, created_at=created_at)
+        return await self._get_versioned(User, stmt, params)
 
     async def create(self, __user: User = None, name: str = None, email: str = None, password: str = None) -> User:
-        async with self.db_client.AsyncSessionDB() as session:
-            if not __user:
-                if None in {name, email, password}:
-                    raise ValueError(f"Incorrect values for user creation")
-                user = User(name=name, email=email, password=password)
-            else:
-                user = __user
+        if __user:
+            name, email, password = __user.name, __user.email, __user.password
+        if None in {name, email, password}:
+            raise ValueError(f"Incorrect values for user creation")
 
-            session.add(user)
+        # Uniqueness of the email is checked by the insert itself - nothing is returned when the email is taken
+        stmt = (
+            insert(User)
+            .values(name=name, email=email, password=password)
+            .on_conflict_do_nothing(index_elements=[User.email])
+            .returning(User)
+        )
+        async with self.db_client.AsyncSessionDB() as session:
+            user = (await session.scalars(stmt)).one_or_none()
             await session.commit()
+
+        if user is None:
+            raise ConflictError(f"User with email '{email}' already exists")
         return user
 
-    async def update(self, __user: User = None, id: int = None, name: str = None, email: str = None, password: str = None) -> User:
+    async def update(self, __user: User = None, id: int = None, name: str = None, email: str = None, password: str = None) -> User | None:
+        # Returns the updated user, or None when there is no user with the id
         if not __user:
             if not id:
                 raise ValueError(f"ID of user must be provided")
             values = {"name": name, "email": email, "password": password}
         else:
+            id = __user.id
             values = {"name": __user.name, "email": __user.email, "password": __user.password}
 
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                update(User)
-                .where(User.id == id if __user is None else User.id == __user.id)
-                .values(
-                    **{k: v for k, v in values.items() if v is not None}
-                )
-                .execution_options(synchronize_session="fetch")
-            )
-            await session.execute(stmt)
-            await session.commit()
-
-            if not __user:
-                result = await session.execute(
-                    select(User).where(User.id == id)
-                )
-                return result.scalar_one_or_none()
+        values = {k: v for k, v in values.items() if v is not None}
+        if not values:
+            users = await self.get(id=id)
+            return users[0] if users else None
 
-            else:
-                return __user
+        stmt = (
+            update(User)
+            .where(User.id == id)
+            .values(**values)
+            .returning(User)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                user = (await session.scalars(stmt)).one_or_none()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == UNIQUE_VIOLATION:
+                raise ConflictError(f"User with email '{values.get("email")}' already exists") from e
+            raise
+        return user
 
-    async def delete(self, __user: User = None,  id: int = None) -> None:
+    async def delete(self, __user: User = None,  id: int = None) -> bool:
+        # Returns False when there is no user with the id
         if not __user:
             if not id:
                 raise ValueError(f"ID of user must be provided")
-            condition = User.id == id
         else:
-            condition = User.id == __user.id
-
-        async with self.db_client.AsyncSessionDB() as session:
-            stmt = (
-                delete(User)
-                .where(condition)
-            )
-            await session.execute(stmt)
-            await session.commit()
+            id = __user.id
 
+        stmt = delete(User).where(User.id == id).returning(User.id)
+        try:
+            async with self.db_client.AsyncSessionDB() as session:
+                deleted = (await session.scalars(stmt)).one_or_none()
+                await session.commit()
+        except IntegrityError as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise ConflictError(f"User {id} still has devices") from e
+            raise
+        return deleted is not None
@@ -1,5 +1,8 @@
 from src.database.models.device import Device
 from src.database.models.command import Command
+from src.database.models.command_history import CommandHistory
 from src.database.models.user import User
+from src.database.models.event import Event
+from src.database.models.event_rollup import EventRollupMinute, EventRollupHour
+from src.database.models.table_version import TableVersion
 from src.database.models._base import Base
-
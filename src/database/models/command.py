@@ -1,11 +1,17 @@
 from src.database.models._base import Base
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import Integer, String, DateTime, JSON, ForeignKey
+from sqlalchemy import Integer, String, DateTime, JSON, Boolean, ForeignKey, Index, text, false
 from datetime import datetime, UTC, timezone
 
 
 class Command(Base):
     __tablename__ = "commands"
+    __table_args__ = (
+        # Delivery only looks for pending commands of a device - the index holds just them, so it stays small
+        Index("ix_commands_pending", "device_id", "id", postgresql_where=text("status = 0")),
+        # Each scheduled command is created once per device and minute, however many ticks run for the minute
+        Index("uq_commands_scheduled", "device_id", "command", "date_time", unique=True, postgresql_where=text("scheduled")),
+    )
 
     id = mapped_column(Integer, primary_key=True)
     date_time = mapped_column(DateTime(timezone=True), default=datetime.now(UTC))
@@ -13,3 +19,5 @@ class Command(Base):
     command = mapped_column(String)
     kwargs = mapped_column(JSON)
     status = mapped_column(Integer)
+    # True for commands created from the regimes of the devices by the scheduler
+    scheduled = mapped_column(Boolean, nullable=False, default=False, server_default=false())
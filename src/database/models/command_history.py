@@ -0,0 +1,20 @@
+from src.database.models._base import Base
+from sqlalchemy.orm import mapped_column
+from sqlalchemy import Integer, String, DateTime, JSON, Index
+
+
+class CommandHistory(Base):
+    __tablename__ = "commands_history"
+    __table_args__ = (
+        Index("ix_commands_history_device_id_id", "device_id", "id"),
+        {"postgresql_partition_by": "RANGE (date_time)"}
+    )
+
+    # Commands keep the id they had in the queue. Primary key of a partitioned table has to include the partitioning column
+    id = mapped_column(Integer, primary_key=True, autoincrement=False)
+    date_time = mapped_column(DateTime(timezone=True), primary_key=True)
+    device_id = mapped_column(Integer)
+    command = mapped_column(String)
+    kwargs = mapped_column(JSON)
+    status = mapped_column(Integer)
+    archived_at = mapped_column(DateTime(timezone=True))
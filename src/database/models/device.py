@@ -1,10 +1,14 @@
 from src.database.models._base import Base
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import Integer, String, DateTime,ForeignKey, JSON
+from sqlalchemy import Integer, String, DateTime,ForeignKey, JSON, UniqueConstraint
 
 
 class Device(Base):
     __tablename__ = "devices"
+    __table_args__ = (
+        # Names of devices are unique per user
+        UniqueConstraint("user_id", "name", name="uq_devices_user_id_name"),
+    )
 
     id = mapped_column(Integer, primary_key=True)
     name = mapped_column(String)
@@ -0,0 +1,17 @@
+from src.database.models._base import Base
+from sqlalchemy.orm import mapped_column
+from sqlalchemy import BigInteger, Integer, DateTime, JSON, Index, Identity
+
+
+class Event(Base):
+    __tablename__ = "events"
+    __table_args__ = (
+        Index("ix_events_device_id_date_time", "device_id", "date_time"),
+        {"postgresql_partition_by": "RANGE (date_time)"}
+    )
+
+    # Primary key of a partitioned table has to include the partitioning column
+    id = mapped_column(BigInteger, Identity(), primary_key=True)
+    date_time = mapped_column(DateTime(timezone=True), primary_key=True)
+    device_id = mapped_column(Integer)
+    payload = mapped_column(JSON)
@@ -0,0 +1,19 @@
+from src.database.models._base import Base
+from sqlalchemy.orm import mapped_column
+from sqlalchemy import BigInteger, Integer, DateTime
+
+
+class _EventRollupColumns:
+    device_id = mapped_column(Integer, primary_key=True)
+    bucket = mapped_column(DateTime(timezone=True), primary_key=True)
+    count = mapped_column(BigInteger)
+    first_at = mapped_column(DateTime(timezone=True))
+    last_at = mapped_column(DateTime(timezone=True))
+
+
+class EventRollupMinute(_EventRollupColumns, Base):
+    __tablename__ = "event_rollups_minute"
+
+
+class EventRollupHour(_EventRollupColumns, Base):
+    __tablename__ = "event_rollups_hour"
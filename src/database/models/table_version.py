@@ -0,0 +1,11 @@
+from src.database.models._base import Base
+from sqlalchemy.orm import mapped_column
+from sqlalchemy import String, BigInteger
+
+
+class TableVersion(Base):
+    __tablename__ = "table_versions"
+
+    # Incremented by a trigger after every statement that changes rows of the table - see TableVersions
+    table_name = mapped_column(String, primary_key=True)
+    version = mapped_column(BigInteger, nullable=False, default=0)
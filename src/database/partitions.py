@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta, UTC
+from typing import Iterable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.database_client import DatabaseClient
+from src.common.logger import Logger
+
+
+class RangePartitioner:
+    """
+    Creates the partitions of a table partitioned by range of a timestamp column
+
+    :param db_client: (DatabaseClient) client of the database the table is stored in
+    :param table: (str) name of the partitioned table
+    :param interval: (str) "day" or "month" - time range covered by each partition
+    """
+
+    def __init__(
+            self,
+            db_client: DatabaseClient,
+            table: str,
+            interval: str = "day"
+    ):
+        if interval not in {"day", "month"}:
+            raise ValueError(f"Unsupported partition interval: {interval}")
+
+        self.db_client = db_client
+        self.table = table
+        self.interval = interval
+        self.logger = Logger()
+
+        self._known: set[datetime] = set()
+
+    def bounds(self, value: datetime) -> tuple[datetime, datetime]:
+        value = value.astimezone(UTC)
+        if self.interval == "day":
+            start = value.replace(hour=0, minute=0, second=0, microsecond=0)
+            return start, start + timedelta(days=1)
+
+        start = value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return start, end
+
+    async def ensure_default(self) -> None:
+        # Rows outside of every created partition land here instead of failing the insert
+        async with self.db_client.AsyncSessionDB() as session:
+            await session.execute(text(f"CREATE TABLE IF NOT EXISTS {self.table}_default PARTITION OF {self.table} DEFAULT"))
+            await session.commit()
+
+    async def ensure(self, values: Iterable[datetime]) -> None:
+        # Create the partitions covering the given timestamps, if they were not created yet
+        missing = sorted(bounds for bounds in {self.bounds(value) for value in values} if bounds[0] not in self._known)
+        if not missing:
+            return
+
+        async with self.db_client.AsyncSessionDB() as session:
+            for start, end in missing:
+                name = f"{self.table}_{start:%Y%m%d}"
+                try:
+                    await session.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {self.table} "
+                        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                    ))
+                    await session.commit()
+                except Exception as e:
+                    # Usually another process created it at the same time. Otherwise the rows go to the default
+                    # partition until a later call creates it
+                    await session.rollback()
+                    if not await self._exists(session, name):
+                        self.logger.warning("Could not create partition %s, retrying with the next rows: %s. %s", name, e.__class__.__name__, e, every=60)
+                        continue
+                self._known.add(start)
+
+    async def _exists(self, session: AsyncSession, name: str) -> bool:
+        # True when the partition is attached to the table. False when it is not, or that can not be checked
+        stmt = text(
+            "SELECT EXISTS (SELECT 1 FROM pg_inherits JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = CAST(:table AS regclass) AND pg_class.relname = :name)"
+        )
+        try:
+            return (await session.execute(stmt, {"table": self.table, "name": name})).scalar_one()
+        except Exception:
+            await session.rollback()
+            return False
@@ -0,0 +1,104 @@
+from sqlalchemy import select, bindparam, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.database_client import DatabaseClient
+from src.database.models import TableVersion
+from src.common.logger import Logger
+
+
+# Transition table of the statement triggers holds the rows changed by the statement - the version is only
+# incremented when there are any, so statements matching no rows do not change it
+BUMP_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM changed) THEN
+        UPDATE {TableVersion.__tablename__} SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+    END IF;
+    RETURN NULL;
+END
+$$
+"""
+
+# Row trigger variant, for updates filtered by the columns they change - transition tables can not be combined with
+# the filter
+BUMP_ROW_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION bump_table_version_row() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE {TableVersion.__tablename__} SET version = version + 1 WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END
+$$
+"""
+
+# Transition tables can not be shared by several events, so every event gets its own trigger
+TRIGGER_EVENTS = {"insert": "NEW", "update": "NEW", "delete": "OLD"}
+
+
+class TableVersions:
+    """
+    Version counters of tables, incremented by statement-level triggers in the same transaction as the change. A
+    version only changes when rows of the table do, so it identifies the content of the table - e.g. for ETags of
+    list endpoints. Writes that change the version wait on the lock of its counter row until the other writers commit,
+    so only tables or columns written at a moderate rate should be versioned. Installing the triggers needs
+    PostgreSQL 14 or newer - tables without a counter row have no version
+
+    :param db_client: (DatabaseClient) client of the database the tables are stored in
+    :param tables: (dict[str, list[str] | None]) names of the versioned tables, with the columns whose updates change
+    the version. None for every column. Updates of other columns, e.g. heartbeat timestamps, neither change the
+    version nor take the lock
+    """
+
+    def __init__(
+            self,
+            db_client: DatabaseClient,
+            tables: dict[str, list[str] | None]
+    ):
+        self.db_client = db_client
+        self.tables = tables
+        self.logger = Logger()
+
+        self._select = select(TableVersion.version).where(TableVersion.table_name == bindparam("table_name"))
+
+    async def install(self) -> None:
+        # Install the triggers and the counter rows. Part of the schema - CREATE TRIGGER locks the table against writes,
+        # so it runs with the schema creation of a deployment, not on every start. Nodes installing at the same time
+        # are serialized by an advisory lock, as concurrent CREATE OR REPLACE of the same function fails
+        async with self.db_client.AsyncSessionDB() as session:
+            await session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": TableVersion.__tablename__})
+            await session.execute(text(BUMP_FUNCTION))
+            await session.execute(text(BUMP_ROW_FUNCTION))
+            for table, columns in self.tables.items():
+                for event, transition in TRIGGER_EVENTS.items():
+                    await session.execute(text(self._trigger(table, event, transition, columns)))
+                await session.execute(text(
+                    f"INSERT INTO {TableVersion.__tablename__} (table_name, version) VALUES (:table, 0) ON CONFLICT DO NOTHING"
+                ), {"table": table})
+            await session.commit()
+        self.logger.info("Version triggers installed on tables %s", list(self.tables))
+
+    @staticmethod
+    def _trigger(table: str, event: str, transition: str, columns: list[str] | None) -> str:
+        name = f"{table}_version_{event}"
+        if event != "update" or columns is None:
+            return (
+                f"CREATE OR REPLACE TRIGGER {name} AFTER {event.upper()} ON {table} "
+                f"REFERENCING {transition} TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()"
+            )
+
+        # Compared as text, as json columns have no equality operator
+        changed = " OR ".join(f"OLD.{column}::text IS DISTINCT FROM NEW.{column}::text" for column in columns)
+        return (
+            f"CREATE OR REPLACE TRIGGER {name} AFTER UPDATE OF {', '.join(columns)} ON {table} "
+            f"FOR EACH ROW WHEN ({changed}) EXECUTE FUNCTION bump_table_version_row()"
+        )
+
+    async def get(self, table: str, session: AsyncSession = None) -> int | None:
+        # Session lets the version be read in the same session as the rows it describes. Read from the primary by
+        # default - a lagging replica would return an older version, and answer a client with 304 right after its own
+        # write. None when the counter row is missing, e.g. the triggers were never installed, so no ETag is sent for
+        # a version that would never change
+        if session is None:
+            async with self.db_client.AsyncSessionDB() as session:
+                return await self.get(table, session)
+
+        return (await session.execute(self._select, {"table_name": table})).scalar_one_or_none()
@@ -0,0 +1,75 @@
+import asyncio
+from contextlib import suppress
+from datetime import datetime, timedelta, UTC
+
+from src.database.managers import CommandManager
+from src.common.logger import Logger
+
+
+class CommandArchiver:
+    """
+    Periodically moves completed commands from the queue to the history, so the queue only holds recent commands
+
+    :param command_manager: (CommandManager) manager the commands are moved with
+    :param interval: (float) number of seconds between two runs
+    :param archive_after: (float) age in seconds a completed command is kept in the queue for
+    :param unacknowledged_after: (float) age in seconds after which a delivered command its device never acknowledged
+    is moved to the history as well. Acknowledgements arriving later find no command in the queue
+    :param batch_size: (int) maximal number of commands moved in one transaction
+    """
+
+    def __init__(
+            self,
+            command_manager: CommandManager,
+            interval: float = 60,
+            archive_after: float = 3600,
+            unacknowledged_after: float = 86400,
+            batch_size: int = 5000
+    ):
+        self.command_manager = command_manager
+        self.interval = interval
+        self.archive_after = archive_after
+        self.unacknowledged_after = unacknowledged_after
+        self.batch_size = batch_size
+        self.logger = Logger()
+
+        self.archived = 0
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.archive()
+            except Exception as e:
+                self.logger.error("Error while archiving commands: %s. %s", e.__class__.__name__, e)
+            await asyncio.sleep(self.interval)
+
+    async def archive(self) -> int:
+        # Move batches until the backlog is cleared. Short transactions keep the locks on the queue brief
+        now = datetime.now(UTC)
+        created_before = now - timedelta(seconds=self.archive_after)
+        delivered_before = now - timedelta(seconds=self.unacknowledged_after)
+        total = 0
+        while True:
+            moved = await self.command_manager.archive(created_before, limit=self.batch_size, delivered_before=delivered_before)
+            total += moved
+            if moved < self.batch_size:
+                break
+
+        if total:
+            self.archived += total
+            self.logger.info("%s commands moved to the history", total)
+        return total
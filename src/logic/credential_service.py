@@ -0,0 +1,143 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.database.managers import UserManager
+from src.database.models import User
+from src.common.lru_cache import LRUCache
+from src.common.logger import Logger
+
+
+# Cost parameters of scrypt - about 16 MB of memory and a few tens of milliseconds per hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_MAXMEM = 64 * 1024 * 1024
+HASH_PREFIX = "scrypt"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=SCRYPT_MAXMEM, dklen=32)
+
+
+class CredentialService:
+    """
+    Hashes and verifies user passwords and issues signed access tokens. Hashing runs in a bounded thread pool - scrypt
+    releases the GIL, so it does not stall the event loop. Verified tokens are cached, so authenticated requests cost
+    one cache lookup
+
+    :param user_manager: (UserManager) manager the users are looked up and updated with
+    :param secret: (str) key the tokens are signed with. A random one is generated if not given, so tokens do not
+    survive a restart
+    :param token_ttl: (float) number of seconds an issued token is valid for
+    :param max_workers: (int) number of threads hashing passwords
+    :param max_pending: (int) maximal number of hashes queued for the threads. Further logins wait on the event loop
+    :param token_cache_size: (int) number of verified tokens kept in memory
+    """
+
+    def __init__(
+            self,
+            user_manager: UserManager,
+            secret: str = None,
+            token_ttl: float = 900,
+            max_workers: int = 4,
+            max_pending: int = 64,
+            token_cache_size: int = 10000
+    ):
+        self.user_manager = user_manager
+        self.token_ttl = token_ttl
+        self.logger = Logger()
+
+        if not secret:
+            self.logger.warning("No token secret configured, tokens issued by this process are only valid until it restarts")
+        self._secret = (secret or secrets.token_hex(32)).encode()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="credentials")
+        self._pending = asyncio.Semaphore(max_pending)
+        self.tokens = LRUCache(maxsize=token_cache_size, ttl=token_ttl)
+
+    async def _run(self, function, *args):
+        async with self._pending:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def hash_password(self, password: str) -> str:
+        salt = os.urandom(16)
+        digest = await self._run(_scrypt, password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f"{HASH_PREFIX}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+
+    async def verify_password(self, password: str, stored: str | None) -> bool:
+        if not stored:
+            return False
+
+        # Passwords stored before hashing was introduced are compared as they are, and rehashed on the next login
+        if not stored.startswith(f"{HASH_PREFIX}$"):
+            return hmac.compare_digest(password.encode(), stored.encode())
+
+        # Malformed hashes, or plaintext passwords that happen to start with the prefix, never match
+        parts = stored.split("$")
+        if len(parts) != 6:
+            self.logger.warning("Stored password hash has an unexpected format")
+            return False
+        try:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            salt, digest = _b64decode(parts[4]), _b64decode(parts[5])
+            computed = await self._run(_scrypt, password, salt, n, r, p)
+        except ValueError as e:
+            self.logger.warning("Stored password hash has an unexpected format: %s. %s", e.__class__.__name__, e)
+            return False
+        return hmac.compare_digest(computed, digest)
+
+    async def login(self, email: str, password: str) -> tuple[str, float] | None:
+        # Returns a token and the time it expires at, or None when the email or the password is wrong. The user is read
+        # from the primary, so logins right after the sign up or a password change do not fail on a lagging replica
+        with self.user_manager.db_client.read_your_writes():
+            users = await self.user_manager.get(email=email)
+        user = users[0] if users else None
+        if user is None or not await self.verify_password(password, user.password):
+            return None
+
+        if not user.password.startswith(f"{HASH_PREFIX}$"):
+            await self.user_manager.update(id=user.id, password=await self.hash_password(password))
+        return self.issue_token(user)
+
+    def issue_token(self, user: User) -> tuple[str, float]:
+        expires_at = time.time() + self.token_ttl
+        payload = _b64encode(json.dumps({"sub": user.id, "exp": expires_at}, separators=(",", ":")).encode())
+        signature = _b64encode(hmac.new(self._secret, payload.encode(), hashlib.sha256).digest())
+        return f"{payload}.{signature}", expires_at
+
+    def verify_token(self, token: str) -> int | None:
+        # Returns the id of the user the token was issued to, or None when it is invalid or expired
+        cached = self.tokens.get(token)
+        if cached is None:
+            cached = self._decode_token(token)
+            if cached is None:
+                return None
+            self.tokens.set(token, cached)
+
+        user_id, expires_at = cached
+        return user_id if expires_at > time.time() else None
+
+    def _decode_token(self, token: str) -> tuple[int, float] | None:
+        try:
+            payload, signature = token.split(".")
+            expected = hmac.new(self._secret, payload.encode(), hashlib.sha256).digest()
+            if not hmac.compare_digest(expected, _b64decode(signature)):
+                return None
+            claims = json.loads(_b64decode(payload))
+            return int(claims["sub"]), float(claims["exp"])
+        except (ValueError, KeyError, TypeError):
+            return None
@@ -0,0 +1,143 @@
+import asyncio
+import time
+from datetime import datetime, UTC
+
+from src.database.managers import EventManager
+from src.common.logger import Logger
+
+
+class EventIngestor:
+    """
+    Buffers device events in a bounded queue and writes them to the database in batches
+
+    :param event_manager: (EventManager) manager the batches are written with
+    :param max_queue_size: (int) maximal number of events waiting to be written
+    :param batch_size: (int) maximal number of events written at once
+    :param flush_interval: (float) maximal number of seconds an event waits before its batch is written
+    :param put_timeout: (float) number of seconds a new event waits for space in a full queue before it is dropped.
+    If 0, events are dropped as soon as the queue is full
+    """
+
+    def __init__(
+            self,
+            event_manager: EventManager,
+            max_queue_size: int = 100000,
+            batch_size: int = 5000,
+            flush_interval: float = 1.0,
+            put_timeout: float = 0
+    ):
+        self.event_manager = event_manager
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.logger = Logger()
+
+        self._queue: asyncio.Queue[tuple[datetime, int, dict] | None] = asyncio.Queue(maxsize=max_queue_size)
+        self._task: asyncio.Task | None = None
+        self._closed = False
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Stop accepting events and wait until everything already queued is written
+        if self._task is None:
+            return
+
+        self._closed = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, device_id: int, event: dict) -> bool:
+        # Returns False if the event was dropped, because the queue is full or the ingestor is stopped
+        if self._closed:
+            self.dropped += 1
+            return False
+
+        item = (datetime.now(UTC), device_id, event)
+        try:
+            if self.put_timeout > 0:
+                await asyncio.wait_for(self._queue.put(item), self.put_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except (asyncio.QueueFull, TimeoutError):
+            self.dropped += 1
+            return False
+
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_size": self.max_queue_size,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flushes": self.flushes,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            # Collect a batch until it is full or the flush interval passes
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    if self._queue.empty():
+                        item = await asyncio.wait_for(self._queue.get(), deadline - loop.time())
+                    else:
+                        item = self._queue.get_nowait()
+                except TimeoutError:
+                    break
+
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+        # Drain whatever is left after the stop signal
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                await self._flush(batch)
+                batch = []
+        if batch:
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[tuple[datetime, int, dict]]) -> None:
+        started = time.perf_counter()
+        try:
+            await self.event_manager.create_many(batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            self.logger.error("Error while writing %s events: %s. %s", len(batch), e.__class__.__name__, e)
+
+        self.flushes += 1
+        self.last_flush_latency = time.perf_counter() - started
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
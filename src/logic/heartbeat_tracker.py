@@ -0,0 +1,76 @@
+import asyncio
+from contextlib import suppress
+from datetime import datetime, timedelta, UTC
+
+from src.database.managers import DeviceManager
+from src.common.logger import Logger
+
+
+class HeartbeatTracker:
+    """
+    Collects the times devices were last seen in memory and writes them to the database in periodic batches
+
+    :param device_manager: (DeviceManager) manager the heartbeats are written with
+    :param flush_interval: (float) number of seconds between two writes
+    :param offline_after: (float) number of seconds without a heartbeat after which a device is marked offline
+    """
+
+    def __init__(
+            self,
+            device_manager: DeviceManager,
+            flush_interval: float = 10,
+            offline_after: float = 120
+    ):
+        self.device_manager = device_manager
+        self.flush_interval = flush_interval
+        self.offline_after = offline_after
+        self.logger = Logger()
+
+        self._last_seen: dict[int, datetime] = {}
+        self._task: asyncio.Task | None = None
+
+    def touch(self, device_id: int) -> None:
+        # Repeated heartbeats of a device between two flushes are coalesced into one row
+        self._last_seen[device_id] = datetime.now(UTC)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+        # Write heartbeats collected since the last flush. A failure is only logged, so the rest of the shutdown runs
+        try:
+            await self.flush()
+        except Exception as e:
+            self.logger.error("Error while writing device heartbeats on shutdown, %s heartbeats lost: %s. %s", len(self._last_seen), e.__class__.__name__, e)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.error("Error while writing device heartbeats: %s. %s", e.__class__.__name__, e)
+
+    async def flush(self) -> None:
+        last_seen, self._last_seen = self._last_seen, {}
+        if last_seen:
+            try:
+                await self.device_manager.touch_many(last_seen)
+            except BaseException:
+                # Put the heartbeats back, unless newer ones arrived in the meantime
+                for device_id, seen_at in last_seen.items():
+                    self._last_seen.setdefault(device_id, seen_at)
+                raise
+
+        offline = await self.device_manager.mark_offline(datetime.now(UTC) - timedelta(seconds=self.offline_after))
+        if offline:
+            self.logger.info("%s devices went offline", len(offline))
@@ -1,38 +1,48 @@
-from src.database.managers import DeviceManager, CommandManager
-from src.database.models import Command
+import asyncio
+from contextlib import suppress
+from datetime import datetime, UTC, timedelta
+
+from src.database.managers import CommandManager
 from src.common.logger import Logger
-from datetime import datetime, UTC
 
 
 class TimeChecker:
     def __init__(
             self,
-            device_manager: DeviceManager,
             command_manager: CommandManager
     ):
-        self.device_manager = device_manager
         self.command_manager = command_manager
         self.logger = Logger()
 
-    async def check(self, device_id: int) -> None:
-        devices = await self.device_manager.get(id=device_id)
-        if not devices:
-            raise Exception(f"No device found with id: {device_id}")
+        self._task: asyncio.Task | None = None
+        self._last_tick: datetime | None = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
 
-        device = devices[0]
-        now_utc = datetime.now(UTC)
-        hour_minute_now = now_utc.strftime("%H:%M")
-        state = device.regime.get(hour_minute_now)
-        if state is None:
-            return
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
 
-        command = await self.command_manager.create(Command(
-            date_time=now_utc,
-            device_id=device.id,
-            command="turn_on",
-            kwargs={},
-            status=0
-        ))
-        return None
+    async def _run(self) -> None:
+        while True:
+            minute = datetime.now(UTC).replace(second=0, microsecond=0)
+            if minute != self._last_tick:
+                try:
+                    await self.tick(minute)
+                except Exception as e:
+                    self.logger.error("Error while creating scheduled commands for %s: %s. %s", f"{minute:%H:%M}", e.__class__.__name__, e)
+                self._last_tick = minute
 
+            next_minute = minute + timedelta(minutes=1)
+            await asyncio.sleep(max((next_minute - datetime.now(UTC)).total_seconds(), 0))
 
+    async def tick(self, minute: datetime) -> list[int]:
+        device_ids = await self.command_manager.create_scheduled(minute)
+        if device_ids:
+            self.logger.info("Created scheduled commands for %s devices at %s", len(device_ids), f"{minute:%H:%M}")
+        return device_ids
@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src.database.instrumentation import InstrumentedAsyncPool, QueryInstrumentation
+
+pytest.importorskip("aiosqlite")
+
+
+def test_checkout_wait_is_recorded_for_every_concurrent_checkout():
+    # One connection and five tasks holding it in turn - every checkout but the first waits, and all five are timed
+    async def run() -> QueryInstrumentation:
+        instrumentation = QueryInstrumentation()
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=InstrumentedAsyncPool, pool_size=1, max_overflow=0, pool_timeout=10)
+        instrumentation.attach(engine, "primary", max_connections=1)
+
+        async def hold() -> None:
+            async with engine.connect():
+                await asyncio.sleep(0.05)
+
+        try:
+            await asyncio.gather(*[hold() for _ in range(5)])
+        finally:
+            await engine.dispose()
+        return instrumentation
+
+    instrumentation = asyncio.run(run())
+    assert instrumentation.checkout_wait.count == 5
+    assert instrumentation.checkout_wait.max >= 0.15
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from src.database.database_client import DatabaseClient
+from src.database.managers import UserManager
+from src.database.models import User
+from src.logic.credential_service import CredentialService
+from src.api.api.base_api import ReadYourWritesMiddleware
+
+pytest.importorskip("aiosqlite")
+
+
+# Replication is not simulated - the primary and the replica are separate databases, so a row only written to the
+# primary stands for a write the replica has not received yet
+
+
+async def _create_databases(tmp_path) -> DatabaseClient:
+    db_client = DatabaseClient(
+        db_dsn=f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}",
+        replica_dsns=[f"sqlite+aiosqlite:///{tmp_path / 'replica.db'}"]
+    )
+    engines = [("primary", db_client._engine), ("replica", db_client._replicas[0].engine)]
+    for name, engine in engines:
+        async with engine.begin() as conn:
+            await conn.execute(text("CREATE TABLE origin (name TEXT)"))
+            await conn.execute(text("INSERT INTO origin VALUES (:name)"), {"name": name})
+            await conn.run_sync(User.__table__.create)
+    return db_client
+
+
+async def _origin(db_client: DatabaseClient) -> str:
+    async with db_client.read_session() as session:
+        return (await session.execute(text("SELECT name FROM origin"))).scalar_one()
+
+
+def test_reads_go_to_the_replica_unless_they_have_to_see_writes(tmp_path):
+    async def run() -> tuple[str, str]:
+        db_client = await _create_databases(tmp_path)
+        try:
+            replica = await _origin(db_client)
+            with db_client.read_your_writes():
+                primary = await _origin(db_client)
+            return replica, primary
+        finally:
+            await db_client.stop()
+
+    assert asyncio.run(run()) == ("replica", "primary")
+
+
+def test_unreachable_replica_falls_back_to_the_primary(tmp_path):
+    async def run() -> str:
+        db_client = DatabaseClient(
+            db_dsn=f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}",
+            replica_dsns=[f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}"]
+        )
+        async with db_client._engine.begin() as conn:
+            await conn.execute(text("CREATE TABLE origin (name TEXT)"))
+            await conn.execute(text("INSERT INTO origin VALUES ('primary')"))
+        try:
+            return await _origin(db_client)
+        finally:
+            await db_client.stop()
+
+    assert asyncio.run(run()) == "primary"
+
+
+def test_login_right_after_sign_up_finds_the_user_on_the_primary(tmp_path):
+    async def run() -> tuple | None:
+        db_client = await _create_databases(tmp_path)
+        credential_service = CredentialService(user_manager=UserManager(db_client=db_client), secret="secret")
+        try:
+            async with db_client.AsyncSessionDB() as session:
+                session.add(User(name="user", email="user@example.com", password=await credential_service.hash_password("password")))
+                await session.commit()
+            return await credential_service.login("user@example.com", "password")
+        finally:
+            await db_client.stop()
+
+    assert asyncio.run(run()) is not None
+
+
+def test_reads_of_a_client_that_just_wrote_go_to_the_primary(tmp_path):
+    async def run() -> list[str]:
+        db_client = await _create_databases(tmp_path)
+        origins = []
+
+        async def app(scope, receive, send) -> None:
+            if scope["method"] == "GET":
+                origins.append(await _origin(db_client))
+
+        middleware = ReadYourWritesMiddleware(app, db_client=db_client)
+
+        async def request(method: str, token: str) -> None:
+            scope = {"type": "http", "method": method, "headers": [(b"authorization", token.encode())], "client": ("127.0.0.1", 1)}
+            await middleware(scope, None, None)
+
+        try:
+            await request("GET", "Bearer a")
+            await request("POST", "Bearer a")
+            await request("GET", "Bearer a")
+            await request("GET", "Bearer b")
+        finally:
+            await db_client.stop()
+        return origins
+
+    assert asyncio.run(run()) == ["replica", "primary", "replica"]